@@ -0,0 +1,319 @@
+import os
+import io
+import gzip
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+from aoe_app_utils import query_data, select_data, get_options
+from aoe_app_storage import ChunkStream, DOWNLOAD_CHUNK_BYTES
+from aoe_app_datasets import SCHEMAS, Dataset, apply_schema, parse_csv
+from aoe_app_index import build_filter_index, build_search_index, search_values
+from aoe_app_civ_compare import build_cube, query_cube, query_matrix, matchup_stats, build_heatmap
+from aoe_app_civ_performance import COMPARE_MAX_CIVS, build_series_index, lookup_series, chart_data
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Offline benchmark of the load -> filter -> aggregate pipeline on synthetic copies of the three consumption views.
+# Generated files are written as gzipped csvs under `--data-dir`, laid out like the `consumption/` folder in adls2,
+# and reused across runs. Every stage is timed separately and the results are written as json for comparing commits.
+#
+#   python aoe_app_benchmark.py --rows 100000 1000000 --output bench_results.json
+SCALES = [100_000, 1_000_000, 10_000_000]
+DATA_DIR = '.bench_data'
+SEED = 42
+
+N_CIVS = 45
+N_MAPS = 30
+N_COUNTRIES = 120
+N_DAYS = 365
+ELO_BUCKETS = ['<800', '800-1000', '1000-1200', '1200-1400', '1400-1600', '1600-1800', '1800-2000', '2000+']
+
+l_file_path = "consumption/vw_leaderboard_analysis.csv.gz"
+cc_file_path = "consumption/vw_opponent_civ_analysis.csv.gz"
+cp_file_path = "consumption/vw_civ_performance_analysis.csv.gz"
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _labels(prefix, n):
+    return np.array([f"{prefix}_{i:03d}" for i in range(n)], dtype=object)
+
+
+def generate_view(file_path, n_rows, seed=SEED) -> pd.DataFrame:
+    '''Deterministic synthetic version of one consumption view with realistic cardinalities.'''
+    rng = np.random.default_rng(seed)
+    civs, maps, countries = _labels('civ', N_CIVS), _labels('map', N_MAPS), _labels('country', N_COUNTRIES)
+    elos = np.array(ELO_BUCKETS, dtype=object)
+    dates = pd.date_range('2024-01-01', periods=N_DAYS).strftime('%Y-%m-%d').to_numpy(dtype=object)
+
+    if file_path == l_file_path:
+        wins = rng.integers(0, 500, n_rows)
+        losses = rng.integers(0, 500, n_rows)
+        return pd.DataFrame({
+            'player_name': 'player_' + pd.Series(rng.permutation(n_rows)).astype(str),
+            'rank': np.arange(1, n_rows + 1),
+            'rating': np.sort(rng.integers(600, 3000, n_rows))[::-1],
+            'country': countries[rng.zipf(1.5, n_rows) % N_COUNTRIES],
+            'win_percentage': np.round(wins / np.maximum(wins + losses, 1) * 100, 2),
+            'total_matches': wins + losses,
+            'wins': wins,
+            'losses': losses,
+            'last_played': dates[rng.integers(0, N_DAYS, n_rows)],
+        })
+
+    matches_played = rng.integers(1, 200, n_rows)
+    frame = {
+        'civ': civs[rng.integers(0, N_CIVS, n_rows)],
+        'map': maps[rng.zipf(1.3, n_rows) % N_MAPS],
+        'match_elo_bucket': elos[rng.integers(0, len(elos), n_rows)],
+    }
+    if file_path == cc_file_path:
+        frame['opponent_civ'] = civs[rng.integers(0, N_CIVS, n_rows)]
+    else:
+        frame['game_date'] = dates[rng.integers(0, N_DAYS, n_rows)]
+    frame['matches_played'] = matches_played
+    frame['wins'] = rng.binomial(matches_played, 0.5)
+    return pd.DataFrame(frame)
+
+
+def ensure_view_file(data_dir, file_path, n_rows):
+    '''Path of the gzipped csv for a view at a scale, generating it on first use.'''
+    path = os.path.join(data_dir, str(n_rows), file_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        generate_view(file_path, n_rows).to_csv(tmp_path, index=False, compression='gzip')
+        os.replace(tmp_path, path)
+    return path
+
+
+def timed(results, stage, func, repeat=1, **tags):
+    '''Run `func` `repeat` times, record the best and median wall time for `stage` and return the last result.'''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        timings.append(time.perf_counter() - start)
+    results.append({
+        'stage': stage,
+        'best_s': min(timings),
+        'median_s': float(np.median(timings)),
+        'repeat': repeat,
+        **tags,
+    })
+    return value
+
+
+def load_str_pandas(compressed, schema):
+    '''The old buffered load: decode the whole file to a python str, infer dtypes, then apply the schema.'''
+    text = gzip.decompress(compressed).decode('utf-8')
+    return apply_schema(pd.read_csv(io.StringIO(text)), schema)
+
+
+def load_schema(compressed, schema):
+    '''The schema driven load straight from the compressed bytes, see `parse_csv`.'''
+    return apply_schema(parse_csv(compressed, schema, 'gzip'), schema)
+
+
+LOAD_PATHS = {'load_str_pandas': load_str_pandas, 'load_schema': load_schema}
+
+
+def _peak_rss():
+    '''Peak resident memory of this process in bytes. On linux the peak is first reset (see `_reset_peak_rss`), as
+        ru_maxrss carries over from the parent process.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        # ru_maxrss is in KiB on linux and bytes on macos
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if platform.system() == 'Darwin' else 1024)
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_memory_worker(load_path, path, file_path, trace, queue):
+    with open(path, 'rb') as f:
+        compressed = f.read()
+    schema = SCHEMAS.get(file_path)
+    if trace:
+        tracemalloc.start()
+    _reset_peak_rss()
+    rss_before = _peak_rss()
+    LOAD_PATHS[load_path](compressed, schema)
+    if trace:
+        # numpy and python allocations are traced, pyarrow's own pool keeps its own high-water mark
+        queue.put(tracemalloc.get_traced_memory()[1] + pa.default_memory_pool().max_memory())
+    else:
+        queue.put(_peak_rss() - rss_before)
+
+
+def peak_memory(load_path, path, file_path, trace):
+    '''Peak memory of one load path, run in a fresh process so the high-water marks only see that load.
+        `trace=True` returns the traced python / numpy peak plus pyarrow's pool peak, otherwise the growth of the peak
+        RSS (kept separate, as tracing inflates RSS with its own bookkeeping).
+    '''
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_peak_memory_worker, args=(load_path, path, file_path, trace, queue))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return int(peak)
+
+
+def _set_query(prefix, selections):
+    for col, values in selections.items():
+        st.session_state[f"{prefix}_{col}_query"] = values
+
+
+def bench_view(results, data_dir, file_path, n_rows, repeat):
+    '''Time every stage for one view at one scale.'''
+    tags = {'dataset': os.path.basename(file_path).split('.')[0], 'rows': n_rows}
+    path = ensure_view_file(data_dir, file_path, n_rows)
+
+    with open(path, 'rb') as f:
+        compressed = f.read()
+    decompressed = timed(results, 'gzip_decode', lambda: gzip.decompress(compressed), repeat, **tags)
+    inferred = timed(results, 'csv_parse', lambda: pd.read_csv(io.BytesIO(decompressed)), repeat, **tags)
+    del decompressed
+
+    # Schema driven pyarrow parse straight from the compressed bytes (gzip decode included), see `parse_csv`
+    schema = SCHEMAS.get(file_path)
+    parsed = timed(
+        results, 'csv_parse_schema', lambda: parse_csv(compressed, schema, compression='gzip'), repeat, **tags
+    )
+    del inferred, parsed
+
+    # End to end load, compressed bytes to the final frame: the old buffered path (decode to str, infer dtypes)
+    # against the schema driven one. Both end with the same frame, so the memory saving is in their peak usage
+    for load_path, load in LOAD_PATHS.items():
+        frame = timed(results, load_path, lambda: load(compressed, schema), repeat, **tags)
+        results.append({
+            'stage': 'load_peak_memory',
+            'load_path': load_path,
+            'peak_bytes': peak_memory(load_path, path, file_path, trace=True),
+            'rss_peak_bytes': peak_memory(load_path, path, file_path, trace=False),
+            'frame_bytes': int(frame.memory_usage(deep=True).sum()),
+            **tags,
+        })
+        del frame
+
+    # The production streamed read: download sized chunks fed through `ChunkStream` to the schema driven parser
+    def stream_parse():
+        chunks = (
+            compressed[i:i + DOWNLOAD_CHUNK_BYTES] for i in range(0, len(compressed), DOWNLOAD_CHUNK_BYTES)
+        )
+        return parse_csv(io.BufferedReader(ChunkStream(chunks)), schema, 'gzip')
+    df = timed(results, 'stream_decode_parse', stream_parse, repeat, **tags)
+
+    df = timed(results, 'apply_schema', lambda: apply_schema(df, SCHEMAS.get(file_path)), 1, **tags)
+    filter_index = timed(results, 'build_filter_index', lambda: build_filter_index(df), 1, **tags)
+    dataset = Dataset(name=file_path, df=df, version='bench', loaded_at=time.time(), filter_index=filter_index)
+
+    if file_path == l_file_path:
+        filters, prefix = ['player_name', 'country'], 'l'
+        selections = {'player_name': [], 'country': df['country'].cat.categories[:3].tolist()}
+    elif file_path == cc_file_path:
+        filters, prefix = ['opponent_civ', 'map', 'match_elo_bucket'], 'cc'
+        selections = {
+            'opponent_civ': df['opponent_civ'].cat.categories[:2].tolist(),
+            'map': df['map'].cat.categories[:3].tolist(),
+            'match_elo_bucket': [],
+        }
+    else:
+        filters, prefix = ['civ', 'map', 'match_elo_bucket'], 'cp'
+        selections = {col: df[col].cat.categories[:1].tolist() for col in filters}
+
+    _set_query(prefix, selections)
+    selected_rows = timed(results, 'query_data', lambda: query_data(dataset, filters, prefix), repeat, **tags)
+
+    # Option lists: the first build is the per-version cost, later calls are the per-rerun cost
+    timed(results, 'options_build', lambda: [get_options(dataset, col) for col in filters], 1, **tags)
+    timed(results, 'options_cached', lambda: [get_options(dataset, col) for col in filters], repeat, **tags)
+    timed(results, 'options_cascaded', lambda: [get_options(dataset, col, selections) for col in filters], repeat, **tags)
+
+    # Each page's aggregation, without the streamlit rendering
+    if file_path == l_file_path:
+        timed(results, 'aggregate', lambda: select_data(df, selected_rows), repeat, **tags)
+        search_index = timed(
+            results, 'search_index_build', lambda: build_search_index(df['player_name'].cat.categories), 1, **tags
+        )
+        timed(results, 'search_lookup', lambda: search_values(search_index, 'player_12', 50), repeat, **tags)
+    elif file_path == cc_file_path:
+        cube = timed(results, 'aggregate_build', lambda: build_cube(df), 1, **tags)
+        timed(results, 'aggregate', lambda: query_cube(cube, selections), repeat, **tags)
+        timed(results, 'matchup_matrix', lambda: matchup_stats(query_matrix(cube, selections)), repeat, **tags)
+        # Heatmap cells, then the chart spec as serialised for the browser
+        matrix = query_matrix(cube, selections)
+        heatmap = timed(results, 'build_heatmap', lambda: build_heatmap(matrix), repeat, **tags)
+        timed(results, 'heatmap_spec', heatmap.to_dict, repeat, **tags)
+    else:
+        series_index = timed(results, 'aggregate_build', lambda: build_series_index(df), 1, **tags)
+        timed(
+            results, 'aggregate',
+            lambda: lookup_series(series_index, *(selections[col][0] for col in filters)), repeat, **tags
+        )
+        # Chart payload for the selected civ compared against the most civs the page allows
+        _, map_name, match_elo_bucket = (selections[col][0] for col in filters)
+        civs = df['civ'].cat.categories[:1 + COMPARE_MAX_CIVS]
+        series = pd.concat(
+            [lookup_series(series_index, civ, map_name, match_elo_bucket) for civ in civs], ignore_index=True
+        ).rename(columns={'civ': 'Civ', 'game_date': 'Match Date', 'matches_played': 'Matches Played', 'wins': 'Wins'})
+        series['Match Date'] = pd.to_datetime(series['Match Date'])
+        timed(results, 'chart_data', lambda: chart_data(series), repeat, **tags)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the load -> filter -> aggregate pipeline offline.')
+    parser.add_argument('--rows', type=int, nargs='+', default=SCALES[:1], help='scales to run, e.g. 100000 1000000')
+    parser.add_argument('--views', nargs='+', default=[l_file_path, cc_file_path, cp_file_path])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    results = []
+    for n_rows in args.rows:
+        for file_path in args.views:
+            bench_view(results, args.data_dir, file_path, n_rows, args.repeat)
+            print(f"benchmarked {file_path} at {n_rows:,} rows")
+
+    report = {
+        'commit': _git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
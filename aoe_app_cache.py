@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import pandas as pd
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Local on-disk snapshot cache of parsed datasets, stored as parquet.
+# Each snapshot is keyed by storage account, container, path and the remote version (etag + last modified), so a
+# process restart only needs one metadata call and a local parquet read instead of a full download and csv parse.
+#
+# Safe with several streamlit worker processes sharing the same directory:
+#   - snapshots are written to a unique temp file and atomically renamed into place, readers never see partial files
+#     (`write_atomic`, also used for the shared memory copies and the query engine's copies)
+#   - eviction and reads tolerate files disappearing underneath them (another process evicted it first)
+CACHE_DIR = os.environ.get('AOE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'aoe_app_cache'))
+CACHE_MAX_BYTES = int(float(os.environ.get('AOE_CACHE_MAX_MB', 512)) * 1024 * 1024)
+SNAPSHOT_SUFFIX = '.parquet'
+
+logger = logging.getLogger('aoe_app.cache')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def snapshot_key(storage_account, container, file_path, version):
+    '''Stable file name for a dataset snapshot, changes whenever the remote version changes.'''
+    raw = '|'.join([storage_account, container, file_path, str(version)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _snapshot_path(key):
+    return os.path.join(CACHE_DIR, key + SNAPSHOT_SUFFIX)
+
+
+def load_snapshot(key):
+    '''Return the cached DataFrame for `key`, or None on a miss (or an unreadable snapshot).'''
+    path = _snapshot_path(key)
+    try:
+        df = pd.read_parquet(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+    # Bump the mtime so eviction treats it as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return df
+
+
+def save_snapshot(key, df: pd.DataFrame):
+    '''Atomically write `df` as the snapshot for `key`, then evict old snapshots over the size budget.'''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _snapshot_path(key)
+    try:
+        write_atomic(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+    except Exception as e:
+        logger.warning(f"Unable to write snapshot {path}: {e}")
+        return
+    evict_snapshots(keep=key)
+
+
+def evict_snapshots(max_bytes=CACHE_MAX_BYTES, keep=None):
+    '''Delete least recently used snapshots until the cache directory fits in `max_bytes`.
+        Stale temp files left behind by crashed writers are removed as well.
+    '''
+    entries = []
+    try:
+        names = os.listdir(CACHE_DIR)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if name.endswith('.tmp'):
+            # Anything older than an hour is an abandoned write
+            if time.time() - stat.st_mtime > 3600:
+                remove_quietly(path)
+            continue
+        if name.endswith(SNAPSHOT_SUFFIX):
+            entries.append((stat.st_mtime, stat.st_size, name, path))
+
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, name, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and name == keep + SNAPSHOT_SUFFIX:
+            continue
+        remove_quietly(path)
+        total -= size
+
+
+def write_atomic(path, write):
+    '''Create `path` by calling `write(tmp_path)` on a unique temp name next to it, then renaming that into place.
+        Readers in any process see either the old file or the complete new one. On failure the temp file is removed
+        and the error re-raised.
+    '''
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove_quietly(tmp_path)
+        raise
+
+
+def remove_quietly(path):
+    '''Remove a file that another process may already have removed.'''
+    try:
+        os.remove(path)
+    except OSError:
+        pass
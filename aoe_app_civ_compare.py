@@ -1,59 +1,211 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import altair as alt
+from aoe_app_utils import get_options, paged_table
+from aoe_app_telemetry import span
+from aoe_app_results import result_cache
+from aoe_app_query import run_query
 
-def get_filters(transformed_df: pd.DataFrame, prefix):
+# Dimensions and measures of the precomputed matchup cube, see `build_cube`
+CUBE_DIMENSIONS = ['civ', 'opponent_civ', 'map', 'match_elo_bucket']
+CUBE_MEASURES = ['matches_played', 'wins']
+
+# Normal quantile for the matchup win % confidence intervals, see `matchup_stats`
+CI_Z = 1.96
+CI_LEVEL = '95%'
+
+# The same aggregation declared for the optional query engine, see `aoe_app_query`
+QUERY = {
+    'filters': ['opponent_civ', 'map', 'match_elo_bucket'],
+    'group_by': ['civ', 'opponent_civ'],
+    'measures': {
+        'Matches_Played': ('matches_played', 'sum'),
+        'Wins_against_Opponent': ('wins', 'sum'),
+    },
+}
+
+def get_filters(dataset, prefix):
     '''Splits the page into 2 for both multiselect filters.
         Saves the selection into a dictionary which is used to update session_state filters later.
         Reset button can be used as a shortcut which will reset all filters.    
+        Options are cached per dataset version and cascade on the other filters' applied values.
+        Selections only take effect on Apply.
     '''
-    filter1, gap, filter2, gap2, filter3 = st.columns([5,1,5,1,5])
-    with filter1:
-        opponent_civ_select = st.multiselect(
-            label='Select the opponent civ to counter against'
-            ,options=sorted(set(transformed_df['opponent_civ'].tolist()))
-            ,key=f"{prefix}_opponent_civ_{st.session_state.counter}"
-            ,placeholder="ALL - (All values are applied)"
-        )
+    keys = {col: f"{prefix}_{col}_{st.session_state.counter}" for col in ['opponent_civ', 'map', 'match_elo_bucket']}
+    current = {col: st.session_state.get(key, []) for col, key in keys.items()}
 
-    with filter2:
-        map_select = st.multiselect(
-            label='Select a map'
-            ,options=sorted(set(transformed_df['map'].tolist()))
-            ,key=f"{prefix}_map_{st.session_state.counter}"
-            ,placeholder="ALL - (All values are applied)"
-        )
-    
-    with filter3:
-        match_elo_bucket_select = st.multiselect(
-            label='Select the elo range to analyse'
-            ,options=sorted(set(transformed_df['match_elo_bucket'].tolist()))
-            ,key=f"{prefix}_match_elo_bucket_{st.session_state.counter}"
-            ,placeholder="ALL - (All values are applied)"
-        )
+    # Changes are batched in a form, so picking several civs, maps and elo ranges is one rerun on Apply
+    with st.form(key=f"{prefix}_filters_{st.session_state.counter}", border=False):
+        filter1, gap, filter2, gap2, filter3 = st.columns([5,1,5,1,5])
+        with filter1:
+            opponent_civ_select = st.multiselect(
+                label='Select the opponent civ to counter against'
+                ,options=get_options(dataset, 'opponent_civ', current)
+                ,key=keys['opponent_civ']
+                ,placeholder="ALL - (All values are applied)"
+            )
 
+        with filter2:
+            map_select = st.multiselect(
+                label='Select a map'
+                ,options=get_options(dataset, 'map', current)
+                ,key=keys['map']
+                ,placeholder="ALL - (All values are applied)"
+            )
     
+        with filter3:
+            match_elo_bucket_select = st.multiselect(
+                label='Select the elo range to analyse'
+                ,options=get_options(dataset, 'match_elo_bucket', current)
+                ,key=keys['match_elo_bucket']
+                ,placeholder="ALL - (All values are applied)"
+            )
+        st.form_submit_button("Apply filters")
+
     st.session_state[f'{prefix}_opponent_civ_query'] = [el for el in opponent_civ_select]
     st.session_state[f'{prefix}_map_query'] = [el for el in map_select]
     st.session_state[f'{prefix}_match_elo_bucket_query'] = [el for el in match_elo_bucket_select]
 
 
-def build_graphs(transformed_df):
-    '''Filters the dataframe to only retain selected rows.
-        Utilising some containserisation, create the graphs and data preview objects.
+def build_cube(df: pd.DataFrame):
+    '''Dense array of `matches_played`, `wins` and row counts summed over (civ, opponent_civ, map, elo),
+        indexed by category codes. Built once per dataset, after which any filter combination is a slice-and-sum.
     '''
-    filtered_df = transformed_df[transformed_df['selected'] == True]
-    
+    categories = [df[col].cat.categories for col in CUBE_DIMENSIONS]
+    shape = tuple(len(cats) for cats in categories)
+    codes = [df[col].cat.codes.to_numpy() for col in CUBE_DIMENSIONS]
+    # Rows missing any dimension (code -1) have no cell, the same rows a grouped aggregation would drop
+    valid = np.logical_and.reduce([dim_codes >= 0 for dim_codes in codes])
+    cell = np.ravel_multi_index([dim_codes[valid] for dim_codes in codes], shape)
+    size = int(np.prod(shape))
+
+    sums = [np.bincount(cell, weights=df[col].to_numpy()[valid], minlength=size) for col in CUBE_MEASURES]
+    # Row counts tell apart matchups with no rows from matchups with rows that sum to 0 matches
+    sums.append(np.bincount(cell, minlength=size))
+    values = np.stack(sums, axis=-1).astype(np.int64).reshape(shape + (len(sums),))
+    return {'categories': categories, 'values': values}
+
+
+def query_matrix(cube, selections):
+    '''Slice the cube by the {column: values} selections and sum it down to dense civ x opponent civ matrices
+        of matches, wins and row counts.
+    '''
+    values = cube['values']
+    # Category codes kept along each axis, so positions in the sliced array map back to values
+    kept = [np.arange(len(cats)) for cats in cube['categories']]
+    for axis, col in enumerate(CUBE_DIMENSIONS):
+        if selections.get(col):
+            codes = cube['categories'][axis].get_indexer(selections[col])
+            kept[axis] = np.unique(codes[codes != -1])
+            values = np.take(values, kept[axis], axis=axis)
+
+    matchups = values.sum(axis=(2, 3))
+    return {
+        'civs': cube['categories'][0][kept[0]],
+        'opponents': cube['categories'][1][kept[1]],
+        'matches': matchups[..., 0],
+        'wins': matchups[..., 1],
+        'rows': matchups[..., 2],
+    }
+
+
+def matrix_from_table(table, civs, opponents):
+    '''The same matrices as `query_matrix`, accumulated from a long civ / opponent civ table (query engine mode).'''
+    shape = (len(civs), len(opponents))
+    cell = np.ravel_multi_index(
+        [civs.get_indexer(table['civ']), opponents.get_indexer(table['opponent_civ'])], shape
+    )
+    size = shape[0] * shape[1]
+    return {
+        'civs': civs,
+        'opponents': opponents,
+        'matches': np.bincount(cell, weights=table['Matches_Played'], minlength=size).astype(np.int64).reshape(shape),
+        'wins': np.bincount(cell, weights=table['Wins_against_Opponent'], minlength=size).astype(np.int64).reshape(shape),
+        'rows': np.bincount(cell, minlength=size).reshape(shape),
+    }
+
+
+def matchup_stats(matrix, z=CI_Z):
+    '''Win % and its Wilson score confidence interval for every matchup at once, NaN where no matches were played.'''
+    n = matrix['matches'].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = matrix['wins'] / n
+        # The interval is only defined for proportions, guard against wins over matches in the source data
+        q = np.clip(p, 0, 1)
+        denominator = 1 + z ** 2 / n
+        centre = (q + z ** 2 / (2 * n)) / denominator
+        half_width = z * np.sqrt(q * (1 - q) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return {
+        'win_rate': p * 100,
+        'ci_low': np.clip(centre - half_width, 0, 1) * 100,
+        'ci_high': np.clip(centre + half_width, 0, 1) * 100,
+    }
+
 
-        # Group and aggregate the data
-    df_updated = (
-        filtered_df.groupby(['civ', 'opponent_civ'])
-        .agg(
-            Matches_Played=('matches_played', 'sum'),
-            Wins_against_Opponent=('wins', 'sum')
+def query_cube(cube, selections):
+    '''Slice the cube by the {column: values} selections and sum it down to one row per civ / opponent civ.'''
+    return matrix_to_table(query_matrix(cube, selections))
+
+
+def matrix_to_table(matrix):
+    '''Long table of the matchups that have rows, one per civ / opponent civ.'''
+    civ_pos, opponent_pos = np.nonzero(matrix['rows'])
+    return pd.DataFrame({
+        'civ': matrix['civs'][civ_pos],
+        'opponent_civ': matrix['opponents'][opponent_pos],
+        'Matches_Played': matrix['matches'][civ_pos, opponent_pos],
+        'Wins_against_Opponent': matrix['wins'][civ_pos, opponent_pos],
+    })
+
+
+def build_heatmap(matrix):
+    '''Interactive civ x opponent civ heatmap of win %, with matches and the confidence interval in the tooltip.
+        Only matchups with rows are sent, as one compact record per cell.
+    '''
+    stats = matchup_stats(matrix)
+    civ_pos, opponent_pos = np.nonzero(matrix['rows'])
+    cells = pd.DataFrame({
+        'Civ': np.asarray(matrix['civs'][civ_pos], dtype=object),
+        'Opponent Civ': np.asarray(matrix['opponents'][opponent_pos], dtype=object),
+        'Matches': matrix['matches'][civ_pos, opponent_pos],
+        'Win %': stats['win_rate'][civ_pos, opponent_pos].round(1),
+        'CI low': stats['ci_low'][civ_pos, opponent_pos].round(1),
+        'CI high': stats['ci_high'][civ_pos, opponent_pos].round(1),
+    })
+
+    return (
+        alt.Chart(cells)
+        .mark_rect()
+        .encode(
+            x=alt.X("Opponent Civ:N", title="Opponent Civ"),
+            y=alt.Y("Civ:N", title="Civ"),
+            color=alt.Color("Win %:Q", scale=alt.Scale(scheme="redblue", domainMid=50)),
+            tooltip=["Civ", "Opponent Civ", "Matches", "Win %", "CI low", "CI high"]
+        )
+        .properties(
+            height=max(400, 14 * len(matrix['civs'])),
+            title=f"Win % against each opponent civ ({CI_LEVEL} confidence interval in tooltip)"
         )
-        .reset_index()
     )
 
+
+def aggregate_matchups(dataset, selections):
+    '''The page's final civ / opponent civ table and heatmap for a selection, summed from the precomputed cube
+        or, in query engine mode, by duckdb.
+    '''
+    df_updated = run_query(dataset, QUERY, selections)
+    if df_updated is None:
+        matrix = query_matrix(dataset.artifact('civ_compare_cube', build_cube), selections)
+        df_updated = matrix_to_table(matrix)
+    else:
+        matrix = matrix_from_table(
+            df_updated, dataset.df['civ'].cat.categories, dataset.df['opponent_civ'].cat.categories
+        )
+
+    with span('chart'):
+        heatmap = build_heatmap(matrix)
+
     # Calculate the win percentage
     df_updated['Win Percentage against Opponent Civ'] = (
         df_updated['Wins_against_Opponent'] / df_updated['Matches_Played'] * 100
@@ -66,18 +218,33 @@ def build_graphs(transformed_df):
         'Matches_Played': 'Matches Played',
         'Wins_against_Opponent': 'Wins against Opponent Civ'
     })
+    return {'table': df_updated, 'heatmap': heatmap}
 
-    
+
+def build_graphs(dataset, selections):
+    '''Aggregates the selected matchups from the precomputed cube (no scan of the raw rows).
+        Results are shared across sessions through the result cache, so a recently viewed selection is a lookup.
+        Utilising some containserisation, create the graphs and data preview objects.
+    '''
+    transformed_df = dataset.df
+
+    # Group and aggregate the data
+    with span('aggregate'):
+        result = result_cache.get_or_build(
+            dataset, 'civ_compare', selections, lambda: aggregate_matchups(dataset, selections)
+        )
+    df_updated, heatmap = result['table'], result['heatmap']
 
     tab1, tab2 = st.tabs(['Graphs', 'Data'])
 
     with tab1:
         st.title("Civ Counter Picker")
-        st.dataframe(df_updated)
+        with span('render'):
+            st.altair_chart(heatmap, use_container_width=True)
+        paged_table(df_updated, key="civ_compare_table")
     with tab2:
         left, right = st.columns(2)
         with left:
-            st.write(transformed_df)
+            paged_table(transformed_df, key="civ_compare_raw_table", dataset=dataset)
         with right:
             st.session_state
-
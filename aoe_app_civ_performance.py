@@ -1,52 +1,101 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-
-def get_filters(transformed_df: pd.DataFrame, prefix):
+from aoe_app_utils import get_options, paged_table
+from aoe_app_telemetry import span
+from aoe_app_results import result_cache
+from aoe_app_query import run_query
+
+# One time series per combination of these columns, see `build_series_index`
+SERIES_KEYS = ['civ', 'map', 'match_elo_bucket']
+
+# Most dates per line sent to the chart, series with more are rebucketed to weeks or months (see `chart_data`)
+CHART_MAX_POINTS = 180
+# Most extra civs that can be drawn against the selected one
+COMPARE_MAX_CIVS = 5
+
+# The same aggregation declared for the optional query engine, see `aoe_app_query`
+QUERY = {
+    'filters': SERIES_KEYS,
+    'group_by': SERIES_KEYS + ['game_date'],
+    'measures': {
+        'matches_played': ('matches_played', 'sum'),
+        'wins': ('wins', 'sum'),
+    },
+}
+
+def _default_index(options):
+    '''Preselect the second option as before, or the only one when the cascaded list is shorter.'''
+    return min(1, len(options) - 1) if options else None
+
+
+def get_filters(dataset, prefix):
     '''Splits the page into 2 for both multiselect filters.
         Saves the selection into a dictionary which is used to update session_state filters later.
         Reset button can be used as a shortcut which will reset all filters.    
+        Options are cached per dataset version, maps only list those played by the selected civ
+        and elo ranges only those seen for the selected civ and map. Other civs can be added for comparison.
     '''
     filter1, gap, filter2, gap2, filter3 = st.columns([5,1,5,1,5])
     with filter1:
+        civ_options = get_options(dataset, 'civ')
         civ_select = st.selectbox(
             label='Select a civ to view performance over time'
-            ,options=sorted(set(transformed_df['civ'].tolist()))
+            ,options=civ_options
             ,key=f"{prefix}_civ_{st.session_state.counter}"
-            ,index=1
+            ,index=_default_index(civ_options)
         )
 
     with filter2:
+        map_options = get_options(dataset, 'map', {'civ': [civ_select]})
         map_select = st.selectbox(
             label='Select a map'
-            ,options=sorted(set(transformed_df['map'].tolist()))
+            ,options=map_options
             ,key=f"{prefix}_cp_map_{st.session_state.counter}"
-            ,index=1
+            ,index=_default_index(map_options)
         )
     
     with filter3:
+        match_elo_bucket_options = get_options(dataset, 'match_elo_bucket', {'civ': [civ_select], 'map': [map_select]})
         match_elo_bucket_select = st.selectbox(
             label='Select the elo range to analyse'
-            ,options=sorted(set(transformed_df['match_elo_bucket'].tolist()))
+            ,options=match_elo_bucket_options
             ,key=f"{prefix}_cp_match_elo_bucket_{st.session_state.counter}"
-            ,index=1
+            ,index=_default_index(match_elo_bucket_options)
+        )
+
+    # Optional civs to draw on the same chart, limited to those with games on the selected map and elo
+    compare_options = [
+        option for option in get_options(dataset, 'civ', {'map': [map_select], 'match_elo_bucket': [match_elo_bucket_select]})
+        if option != civ_select
+    ]
+    compare_key = f"{prefix}_cp_compare_civ_{st.session_state.counter}"
+    if compare_key in st.session_state:
+        # Drop compared civs that the new civ / map / elo no longer offers
+        st.session_state[compare_key] = [civ for civ in st.session_state[compare_key] if civ in compare_options]
+    # Batched in a form, so adding several civs is one rerun on Apply
+    with st.form(key=f"{prefix}_cp_compare_form_{st.session_state.counter}", border=False):
+        compare_civ_select = st.multiselect(
+            label='Compare with other civs'
+            ,options=compare_options
+            ,key=compare_key
+            ,max_selections=COMPARE_MAX_CIVS
+            ,placeholder="None - (Only the selected civ is shown)"
         )
+        st.form_submit_button("Apply comparison")
 
     st.session_state[f'{prefix}_civ_query'] = [civ_select]
     st.session_state[f'{prefix}_map_query'] = [map_select]
     st.session_state[f'{prefix}_match_elo_bucket_query'] = [match_elo_bucket_select]
+    st.session_state[f'{prefix}_compare_civ_query'] = [el for el in compare_civ_select]
 
 
-def build_graphs(transformed_df):
-    '''Filters the dataframe to only retain selected rows.
-        Utilising some containserisation, create the graphs and data preview objects.
+def build_series_index(df: pd.DataFrame):
+    '''Aggregate every (civ, map, elo) series by date once, with `matches_played`, `wins` and win % computed.
+        Rows are sorted by key then date, so each series is a contiguous slice recorded in `slices`.
     '''
-    filtered_df = transformed_df[transformed_df['selected'] == True]
-    
-
-    # Group and aggregate the data
-    df_updated = (
-        filtered_df.groupby(['civ', 'map', 'match_elo_bucket', 'game_date'])
+    series = (
+        df.groupby(SERIES_KEYS + ['game_date'], observed=True)
         .agg(
             matches_played=('matches_played', 'sum'),
             wins=('wins', 'sum')
@@ -55,10 +104,81 @@ def build_graphs(transformed_df):
     )
 
     # Calculate the win percentage
-    df_updated['civ_win_percent'] = (
-        df_updated['wins'] / df_updated['matches_played'] * 100
+    series['civ_win_percent'] = (
+        series['wins'] / series['matches_played'] * 100
     ).round(2)
 
+    slices = {
+        tuple(str(value) for value in key): (positions[0], positions[-1] + 1)
+        for key, positions in series.groupby(SERIES_KEYS, observed=True, sort=False).indices.items()
+    }
+    return {'series': series, 'slices': slices}
+
+
+def lookup_series(series_index, civ, map_name, match_elo_bucket):
+    '''The date-sorted series for one (civ, map, elo) selection, a dictionary lookup and a slice.'''
+    start, stop = series_index['slices'].get((str(civ), str(map_name), str(match_elo_bucket)), (0, 0))
+    return series_index['series'].iloc[start:stop]
+
+
+def aggregate_series(dataset, civs, map_name, match_elo_bucket) -> pd.DataFrame:
+    '''The date-sorted series of each civ for one map / elo, one after another (by duckdb in query engine mode).'''
+    df_updated = run_query(dataset, QUERY, {'civ': civs, 'map': [map_name], 'match_elo_bucket': [match_elo_bucket]})
+    if df_updated is not None:
+        df_updated['civ_win_percent'] = (df_updated['wins'] / df_updated['matches_played'] * 100).round(2)
+        # Same civ order as the in-memory path, selected civ first
+        return pd.concat([df_updated[df_updated['civ'] == str(civ)] for civ in civs], ignore_index=True)
+
+    series_index = dataset.artifact('civ_performance_series', build_series_index)
+    return pd.concat(
+        [lookup_series(series_index, civ, map_name, match_elo_bucket) for civ in civs], ignore_index=True
+    )
+
+
+def chart_frequency(dates, max_points=CHART_MAX_POINTS):
+    '''Bucket size for a chart of `dates`: daily while the distinct dates fit in `max_points`, otherwise weekly
+        while the distinct weeks fit, then monthly. Keyed on points rather than span, so sparse series stay daily.
+    '''
+    if dates.nunique() <= max_points:
+        return None
+    if dates.dt.to_period('W').nunique() <= max_points:
+        return 'W'
+    return 'M'
+
+
+def chart_data(df_updated, max_points=CHART_MAX_POINTS):
+    '''Compact chart payload: one row per date bucket and one win % column per civ, nothing else.
+        Long ranges are rebucketed to weeks or months, with win % recomputed from the summed matches and wins
+        (not averaged), so the line stays exact while the number of points is capped. Returns (frame, frequency).
+    '''
+    if df_updated.empty:
+        return pd.DataFrame(columns=['Match Date']), None
+
+    frequency = chart_frequency(df_updated['Match Date'], max_points)
+    columns = {}
+    for civ, series in df_updated.groupby('Civ', observed=True, sort=False):
+        dates = series['Match Date']
+        if frequency is not None:
+            dates = dates.dt.to_period(frequency).dt.start_time
+        sums = series[['Matches Played', 'Wins']].groupby(dates.to_numpy()).sum()
+        columns[str(civ)] = (sums['Wins'] / sums['Matches Played'] * 100).round(2)
+
+    data = pd.DataFrame(columns).sort_index()
+    # Plain dates are shorter in the spec than full timestamps
+    data.index = data.index.strftime('%Y-%m-%d')
+    return data.rename_axis('Match Date').reset_index(), frequency
+
+
+def build_performance(dataset, selections):
+    '''The page's final series table and line chart for one civ / map / elo selection,
+        plus any civs picked for comparison on the same map and elo.
+    '''
+    # Each filter is a selectbox, so there is exactly one value per key
+    civ, map_name, match_elo_bucket = (selections[col][0] for col in SERIES_KEYS)
+    civs = [civ] + [other for other in selections.get('compare_civ', []) if other != civ]
+    with span('aggregate'):
+        df_updated = aggregate_series(dataset, civs, map_name, match_elo_bucket)
+
     # Rename columns
     df_updated = df_updated.rename(columns={
         'civ': 'Civ',
@@ -76,35 +196,55 @@ def build_graphs(transformed_df):
 
 
     # Create an Altair chart
-    chart = (
-        alt.Chart(df_updated)
-        .mark_line(point=True) 
-        .encode(
-            x=alt.X("Match Date:T", title="Match Date", axis=alt.Axis(format='%Y-%m-%d')), 
-            y=alt.Y("Win %:Q", title="Civ Win (%)"), 
-            tooltip=["Civ", "Map", "Elo", "Match Date", "Win %"]
-        )
-        .properties(
-            width=600,  
-            height=400,  
-            title="Win Percentage Over Time" 
+    with span('chart'):
+        data, frequency = chart_data(df_updated)
+        civ_columns = [column for column in data.columns if column != 'Match Date']
+        bucket = {None: '', 'W': ', weekly', 'M': ', monthly'}[frequency]
+        chart = (
+            alt.Chart(data)
+            # Civs are unpivoted in the browser, so comparing civs adds one number per point rather than whole rows
+            .transform_fold(civ_columns, as_=['Civ', 'Win %'])
+            .mark_line(point=len(data) <= CHART_MAX_POINTS)
+            .encode(
+                x=alt.X("Match Date:T", title="Match Date", axis=alt.Axis(format='%Y-%m-%d')), 
+                y=alt.Y("Win %:Q", title="Civ Win (%)"), 
+                color=alt.Color("Civ:N", sort=civ_columns),
+                tooltip=["Civ:N", alt.Tooltip("Match Date:T", format='%Y-%m-%d'), "Win %:Q"]
+            )
+            .properties(
+                width=600,  
+                height=400,  
+                title=f"Win Percentage Over Time - {map_name}, {match_elo_bucket}{bucket}" 
+            )
         )
-    )
+    return {'table': df_updated, 'chart': chart}
 
 
+def build_graphs(dataset, selections):
+    '''Looks up the selected civ / map / elo series from the precomputed series index (no scan of the raw rows).
+        The table and chart are shared across sessions through the result cache, so a recently viewed selection
+        is a lookup. Utilising some containserisation, create the graphs and data preview objects.
+    '''
+    transformed_df = dataset.df
+
+    result = result_cache.get_or_build(
+        dataset, 'civ_performance', selections, lambda: build_performance(dataset, selections)
+    )
+    df_updated, chart = result['table'], result['chart']
 
     tab1, tab2, tab3 = st.tabs(['Graphs', 'Data', 'Backend'])
 
     with tab1:
         st.title("Civ Performance (Win %)")
-        st.altair_chart(chart, use_container_width=True)
+        with span('render'):
+            st.altair_chart(chart, use_container_width=True)
     with tab2:
         st.title("Civ Performance - Data")
-        st.dataframe(df_updated)
+        paged_table(df_updated, key="civ_performance_table")
     with tab3:
         left, right = st.columns(2)
         with left:
-            st.write(transformed_df)
+            paged_table(transformed_df, key="civ_performance_raw_table", dataset=dataset)
         with right:
             st.session_state
 
@@ -0,0 +1,166 @@
+import io
+import logging
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Per-dataset load schema, used to parse the csv (see `parse_csv`) and applied once at load rather than on every rerun.
+#   columns:    the columns the pages use, any others in the file are skipped while parsing
+#   categories: filter columns stored as categoricals (dictionary encoded, fast `isin` and `groupby`)
+#   integers:   count columns downcast to the smallest integer type that fits
+#   floats:     measure columns read as float64
+#   dates:      columns parsed to datetime once
+#   partitions: optional `column=value` partitioned layout of the same view, e.g. `<path>/game_date=2024-01-31/*.csv.gz`.
+#               When present it is read instead of the single file, and only new or changed partitions are fetched.
+SCHEMAS = {
+    "consumption/vw_leaderboard_analysis.csv.gz": {
+        'columns': [
+            'player_name', 'rank', 'rating', 'country', 'win_percentage', 'total_matches', 'wins', 'losses',
+            'last_played',
+        ],
+        'categories': ['player_name', 'country'],
+        'integers': ['rank', 'rating', 'total_matches', 'wins', 'losses'],
+        'floats': ['win_percentage'],
+        'dates': ['last_played'],
+    },
+    "consumption/vw_opponent_civ_analysis.csv.gz": {
+        'columns': ['civ', 'opponent_civ', 'map', 'match_elo_bucket', 'matches_played', 'wins'],
+        'categories': ['civ', 'opponent_civ', 'map', 'match_elo_bucket'],
+        'integers': ['matches_played', 'wins'],
+        'floats': [],
+        'dates': [],
+    },
+    "consumption/vw_civ_performance_analysis.csv.gz": {
+        'columns': ['civ', 'map', 'match_elo_bucket', 'game_date', 'matches_played', 'wins'],
+        'categories': ['civ', 'map', 'match_elo_bucket'],
+        'integers': ['matches_played', 'wins'],
+        'floats': [],
+        'dates': ['game_date'],
+        'partitions': {'path': 'consumption/vw_civ_performance_analysis', 'column': 'game_date'},
+    },
+}
+
+# Bytes of csv each pyarrow parser thread works on at a time
+CSV_BLOCK_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger('aoe_app.datasets')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@dataclass(frozen=True)
+class Dataset:
+    '''A loaded dataset, held once per process and shared read-only by every session.
+        Pages never modify `df`; filtering produces a selection of row numbers instead (see `query_data`).
+    '''
+    name: str
+    df: pd.DataFrame
+    version: str | None
+    loaded_at: float
+    filter_index: dict
+    artifacts: dict = field(default_factory=dict, repr=False, compare=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    _build_locks: dict = field(default_factory=lambda: defaultdict(threading.Lock), repr=False, compare=False)
+
+    def artifact(self, name, build):
+        '''Derived structure (cube, lookup index, ...) built from `df` on first use, then reused.
+            It lives on the dataset, so it is shared by every session and goes away with this dataset version.
+            Each artifact has its own build lock, so a slow build only holds up callers waiting on that artifact.
+        '''
+        if name in self.artifacts:
+            return self.artifacts[name]
+        with self._lock:
+            build_lock = self._build_locks[name]
+        with build_lock:
+            if name not in self.artifacts:
+                self.artifacts[name] = build(self.df)
+            return self.artifacts[name]
+
+
+def apply_schema(df: pd.DataFrame, schema) -> pd.DataFrame:
+    '''Convert columns in place to the compact dtypes declared in `schema`.
+        Columns that are missing or already converted (e.g. loaded from a parquet snapshot) are skipped.
+    '''
+    if not schema:
+        return df
+
+    for col in schema.get('categories', []):
+        if col not in df.columns:
+            continue
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            # Values are kept as strings and missing ones become 'nan', so option lists always sort cleanly and no
+            # row has a missing category code. pandas 3 keeps missing values through `astype(str)`, hence the fillna
+            df[col] = df[col].astype(str).fillna('nan').astype('category')
+            continue
+        # Already dictionary encoded by the parser: same conventions, sorted categories and 'nan' for missing values
+        if (df[col].cat.codes.to_numpy() == -1).any():
+            if 'nan' not in df[col].cat.categories:
+                df[col] = df[col].cat.add_categories('nan')
+            df[col] = df[col].fillna('nan')
+        if not df[col].cat.categories.is_monotonic_increasing:
+            df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+
+    for col in schema.get('integers', []):
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+
+    for col in schema.get('dates', []):
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col])
+
+    return df
+
+
+def _arrow_column_types(schema):
+    # Categories are read as plain strings and encoded by `apply_schema`. Dictionary encoding in the reader is only
+    # faster for low cardinality columns, and far slower for near-unique ones like player names once sorted
+    types = {col: pa.string() for col in schema.get('categories', [])}
+    types.update({col: pa.int64() for col in schema.get('integers', [])})
+    types.update({col: pa.float64() for col in schema.get('floats', [])})
+    types.update({col: pa.timestamp('us') for col in schema.get('dates', [])})
+    return types
+
+
+def parse_csv(source, schema=None, compression=None) -> pd.DataFrame:
+    '''Parse a csv held in memory (bytes or a pyarrow buffer) or read from a binary file object, with the schema's
+        columns and dtypes. pyarrow's multithreaded reader decodes the raw bytes itself (gzip included, with
+        `compression='gzip'`), skips undeclared columns and converts the declared dtypes as it goes, with no
+        intermediate python str decode. If that fails (e.g. a value doesn't fit its declared type) and `source` is in memory,
+        the pandas parser is used instead. `apply_schema` still has to be applied to the result.
+    '''
+    schema = schema or {}
+    columns = schema.get('columns')
+    in_memory = isinstance(source, (bytes, bytearray, memoryview, pa.Buffer))
+    stream = pa.BufferReader(source) if in_memory else source
+    if compression:
+        stream = pa.CompressedInputStream(stream, compression)
+
+    try:
+        table = pa_csv.read_csv(
+            stream,
+            read_options=pa_csv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=columns,
+                # Declared columns absent from the file come back as nulls (e.g. a partition column kept in the path)
+                include_missing_columns=columns is not None,
+                # Empty cells are missing values, as with pandas, so `apply_schema` gives them the same 'nan' category
+                strings_can_be_null=True,
+                column_types={col: dtype for col, dtype in _arrow_column_types(schema).items()
+                              if columns is None or col in columns},
+            ),
+        )
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    except Exception as e:
+        if not in_memory:
+            raise
+        logger.warning(f"pyarrow csv parse failed, falling back to pandas: {e}")
+
+    return pd.read_csv(
+        io.BytesIO(source),
+        compression=compression,
+        encoding='utf-8',
+        usecols=(lambda col: col in columns) if columns else None,
+    )
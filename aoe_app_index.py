@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Inverted index over the categorical filter columns of a dataset, built once at load.
+# For each column the row numbers are sorted by category code, so the rows holding any one value are a contiguous
+# slice (a posting list). Applying a filter is then a union of the selected values' slices and an intersection
+# across columns, costing the number of matching rows rather than a full `isin` scan of the column.
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def build_filter_index(df: pd.DataFrame):
+    '''Return {column: posting lists} for every categorical column of `df`.'''
+    index = {}
+    for col in df.columns:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        codes = df[col].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable').astype(np.int32)
+        # offsets[c]:offsets[c + 1] is the slice of `order` holding rows with code c (missing values, code -1, sort first)
+        offsets = np.searchsorted(codes[order], np.arange(len(df[col].cat.categories) + 1))
+        index[col] = {
+            'categories': df[col].cat.categories,
+            'order': order,
+            'offsets': offsets,
+        }
+    return index
+
+
+def lookup_rows(column_index, values):
+    '''Sorted row numbers whose value is any of `values` (a union of posting lists).'''
+    codes = column_index['categories'].get_indexer(list(values))
+    order, offsets = column_index['order'], column_index['offsets']
+    postings = [order[offsets[code]:offsets[code + 1]] for code in codes if code != -1]
+    if not postings:
+        return np.empty(0, dtype=np.int32)
+    return np.sort(np.concatenate(postings))
+
+
+def select_rows(filter_index, selections):
+    '''Intersect the rows matching each {column: values} selection. Returns None when nothing is filtered.'''
+    matches = [lookup_rows(filter_index[col], values) for col, values in selections.items() if values]
+    if not matches:
+        return None
+
+    # Intersecting the shortest row lists first keeps every step cheap
+    matches.sort(key=len)
+    rows = matches[0]
+    for col_rows in matches[1:]:
+        if len(rows) == 0:
+            break
+        rows = np.intersect1d(rows, col_rows, assume_unique=True)
+    return rows
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Typeahead search over the values of one categorical column (e.g. player names), built once per dataset version.
+# Prefix matches come from a binary search over the lowercased, sorted values. Substring matches come from a trigram
+# index: the values holding the query's rarest trigram are checked in order until `limit` matches are found.
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def build_search_index(categories):
+    '''Return the prefix and trigram lookups for a column's categories (positions are category codes).'''
+    keys = [str(value).lower() for value in categories]
+    order = np.argsort(np.array(keys, dtype=object), kind='stable')
+    grams = defaultdict(list)
+    for code, key in enumerate(keys):
+        for gram in {key[i:i + 3] for i in range(len(key) - 2)}:
+            grams[gram].append(code)
+
+    return {
+        'categories': categories,
+        'keys': keys,
+        'order': order,
+        'sorted_keys': np.array(keys, dtype=object)[order],
+        'grams': {gram: np.array(codes, dtype=np.int32) for gram, codes in grams.items()},
+    }
+
+
+def search_values(search_index, query, limit=50, allowed=None):
+    '''Up to `limit` values matching `query` (case insensitive), prefix matches first then substring matches.
+        `allowed` is an optional boolean mask over the category codes, values outside it are skipped before the limit.
+    '''
+    query = query.strip().lower()
+    if not query:
+        return []
+
+    sorted_keys, order = search_index['sorted_keys'], search_index['order']
+    start = np.searchsorted(sorted_keys, query, side='left')
+    stop = np.searchsorted(sorted_keys, query + '\uffff', side='left')
+    if allowed is None:
+        codes = order[start:min(stop, start + limit)].tolist()
+    else:
+        prefix_codes = order[start:stop]
+        codes = prefix_codes[allowed[prefix_codes]][:limit].tolist()
+
+    if len(codes) < limit and len(query) >= 3:
+        # Every match holds every trigram of the query, so the rarest trigram's values are the only candidates
+        candidates = min(
+            (search_index['grams'].get(query[i:i + 3], np.empty(0, dtype=np.int32)) for i in range(len(query) - 2)),
+            key=len
+        )
+        seen = set(codes)
+        keys = search_index['keys']
+        for code in map(int, candidates):
+            if code not in seen and (allowed is None or allowed[code]) and query in keys[code]:
+                codes.append(code)
+                if len(codes) >= limit:
+                    break
+
+    return [search_index['categories'][code] for code in codes]
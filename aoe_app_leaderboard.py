@@ -1,63 +1,116 @@
 import streamlit as st
-import pandas as pd
-
-def get_filters(transformed_df: pd.DataFrame, prefix):
-    '''Display multi-select filters and update session state directly.'''
-    transformed_df['player_name'] = transformed_df['player_name'].astype(str)
-    transformed_df['country'] = transformed_df['country'].astype(str)
-
-    filter1, gap, filter2 = st.columns([5,1,5])
-    with filter1:
-        player_name_select = st.multiselect(
-            label='Select the Player Name to lookup',
-            options=sorted(set(transformed_df['player_name'].tolist())),
-            key=f"{prefix}_player_name_query_{st.session_state.counter}",
-            placeholder="ALL - (All values are applied)"
-        )
+import numpy as np
+from aoe_app_utils import select_data, get_options, paged_table
+from aoe_app_index import build_search_index, search_values, select_rows
+from aoe_app_telemetry import span
+
+# Most player names sent to the browser at once, the rest are reached through the search box
+PLAYER_SEARCH_LIMIT = 50
+
 
-    with filter2:
-        country_select = st.multiselect(
-            label='Select a Country to lookup',
-            options=sorted(set(transformed_df['country'].tolist())),
-            key=f"{prefix}_country_query_{st.session_state.counter}",
-            placeholder="ALL - (All values are applied)"
+def search_players(dataset, query, current):
+    '''Player options for the multiselect: the top matches for the search text from the dataset's search index,
+        or the highest ranked players when there is no search text. Players already selected are always kept,
+        and a country selection narrows the candidates to players from those countries before the limit is applied.
+    '''
+    others = {col: values for col, values in current.items() if col != 'player_name' and values}
+    rows = select_rows(dataset.filter_index, others)
+
+    if query.strip():
+        index = dataset.artifact(
+            'player_name_search', lambda df: build_search_index(df['player_name'].cat.categories)
+        )
+        allowed = None
+        if rows is not None:
+            # Players with rows in the selected countries, looked up from the posting lists rather than a rescan
+            allowed = np.zeros(len(index['categories']), dtype=bool)
+            codes = dataset.df['player_name'].cat.codes.to_numpy()[rows]
+            allowed[codes[codes >= 0]] = True
+        matches = search_values(index, query, limit=PLAYER_SEARCH_LIMIT, allowed=allowed)
+    elif rows is None:
+        matches = dataset.artifact(
+            'top_players', lambda df: df.nsmallest(PLAYER_SEARCH_LIMIT, 'rank')['player_name'].astype(str).tolist()
         )
+    else:
+        ranks = dataset.df['rank'].to_numpy()[rows]
+        top_rows = rows[np.argsort(ranks, kind='stable')[:PLAYER_SEARCH_LIMIT]]
+        matches = dataset.df['player_name'].iloc[top_rows].astype(str).tolist()
+
+    selected = current['player_name']
+    return selected + [name for name in matches if name not in selected]
+
+
+def get_filters(dataset, prefix):
+    '''Display multi-select filters and update session state directly.
+        Player names are looked up server side through the search box, so only the matches reach the browser.
+        Country options are cached per dataset version and cascade on the selected players.
+        Selections only take effect on Apply (pressing Enter in the search box applies too).
+    '''
+    keys = {col: f"{prefix}_{col}_query_{st.session_state.counter}" for col in ['player_name', 'country']}
+    current = {col: st.session_state.get(key, []) for col, key in keys.items()}
+
+    # Changes are batched in a form, so picking several players and countries is one rerun on Apply
+    with st.form(key=f"{prefix}_filters_{st.session_state.counter}", border=False):
+        filter1, gap, filter2 = st.columns([5,1,5])
+        with filter1:
+            player_search = st.text_input(
+                label='Search for a Player Name',
+                key=f"{prefix}_player_search_{st.session_state.counter}",
+                placeholder="Type part of a name and press Enter"
+            )
+            player_name_select = st.multiselect(
+                label='Select the Player Name to lookup',
+                options=search_players(dataset, player_search, current),
+                key=keys['player_name'],
+                placeholder="ALL - (All values are applied)"
+            )
+
+        with filter2:
+            country_select = st.multiselect(
+                label='Select a Country to lookup',
+                options=get_options(dataset, 'country', current),
+                key=keys['country'],
+                placeholder="ALL - (All values are applied)"
+            )
+        st.form_submit_button("Apply filters")
 
     # Update session state with selected values
     st.session_state[f"{prefix}_player_name_query"] = player_name_select
     st.session_state[f"{prefix}_country_query"] = country_select
 
 
-def build_graphs(transformed_df):
+def build_graphs(dataset, selected_rows):
     '''Filters the dataframe to only retain selected rows.
         Utilising some containserisation, create the graphs and data preview objects.
+        Tables are paged server side, so only the visible rows are sent to the browser.
     '''
-    filtered_df = transformed_df[transformed_df['selected'] == True]
-    
-    # Rename columns
-    df_updated = filtered_df.rename(columns={
-        'player_name': 'Player Name',
-        'rank': 'Rank',
-        'rating': 'Rating',
-        'country': 'Country',
-        'win_percentage': 'Win Percent',
-        'total_matches': 'Total Matches',
-        'wins': 'Wins',
-        'losses': 'Losses',
-        'last_played': 'Last Played'
-    })
-
-    df_updated = df_updated.drop('selected', axis=1)
+    transformed_df = dataset.df
+    with span('aggregate'):
+        filtered_df = select_data(transformed_df, selected_rows)
+        
+        # Rename columns
+        df_updated = filtered_df.rename(columns={
+            'player_name': 'Player Name',
+            'rank': 'Rank',
+            'rating': 'Rating',
+            'country': 'Country',
+            'win_percentage': 'Win Percent',
+            'total_matches': 'Total Matches',
+            'wins': 'Wins',
+            'losses': 'Losses',
+            'last_played': 'Last Played'
+        })
 
     tab1, tab2 = st.tabs(['Graphs', 'Data'])
 
     with tab1:
         st.title("Aoe2 Weekly Leaderboard")
-        st.dataframe(df_updated)
+        # Same columns and rows as the dataset, so the cached per-column sort orders are reused
+        paged_table(df_updated, key="leaderboard_table", dataset=dataset, rows=selected_rows)
     with tab2:
         left, right = st.columns(2)
         with left:
-            st.write(transformed_df)
+            paged_table(transformed_df, key="leaderboard_raw_table", dataset=dataset)
         with right:
             st.session_state
 
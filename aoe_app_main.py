@@ -1,10 +1,11 @@
+import time
 import streamlit as st
 from streamlit import session_state as ss
-from aoe_app_utils import get_data, initialize_state, reset_state_callback, query_data
+from aoe_app_utils import get_data, prefetch_data, start_refresher, initialize_state, reset_state_callback, query_data, get_selections
 from aoe_app_leaderboard import get_filters as l_get_filters, build_graphs as l_build_graphs
 from aoe_app_civ_compare import get_filters as cc_get_filters, build_graphs as cc_build_graphs
 from aoe_app_civ_performance import get_filters as cp_get_filters, build_graphs as cp_build_graphs
-import time
+from aoe_app_telemetry import span, span_tags, begin_rerun, end_rerun, fragment_run
 
 st.set_page_config(layout='wide')
 # ----------------------------------------------------------------------------------------------------------------------
@@ -25,8 +26,12 @@ cc_prefix = 'cc'
 
 # Civ Performance Analysis
 cp_file_path = "consumption/vw_civ_performance_analysis.csv.gz"  
-cp_categorical_filters = ['civ', 'map', 'match_elo_bucket']
+# `compare_civ` holds the extra civs drawn on the chart for comparison
+cp_categorical_filters = ['civ', 'map', 'match_elo_bucket', 'compare_civ']
 cp_prefix = 'cp'
+
+# Every dataset the app reads, fetched together on a cold start
+registered_file_paths = (l_file_path, cc_file_path, cp_file_path)
 # ----------------------------------------------------------------------------------------------------------------------
 
 def reset_state_callback():
@@ -37,12 +42,14 @@ def reset_state_callback():
             st.session_state[f"{col}_query"] = []
 
 
-def universal_layout(button_key):
+def universal_layout(button_key, dataset):
     top1, gap, main_gap, gap2, top3 = st.columns([2,1,5,1,2])
 
     with top1:
         with st.container(height=75,border=True):
-            st.write("Last Updated: Today!")
+            # When the copy being displayed was loaded, the background refresher replaces it as new versions land.
+            # Drawn inside the page's fragment from the same dataset as the visuals, so a fragment rerun updates both
+            st.write(f"Last Updated: {time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(dataset.loaded_at))}")
     with main_gap:
         with st.container(height=75,border=False):
                 st.markdown("### :crossed_swords: **Age of Empires 2 Analysis** :crossed_swords:")
@@ -51,37 +58,81 @@ def universal_layout(button_key):
             st.button("Reset All filters", on_click=reset_state_callback, use_container_width=True, key=button_key)
 
 
-def main():
-    
-    tab1, tab2, tab3 = st.tabs(["Player Leaderboard", "Civ Counter-picker", "Civ Performance"])
+def leaderboard_page():
+    initialize_state(l_categorical_filters, l_prefix)
+    leaderboard_view()
+
+
+@st.fragment
+def leaderboard_view():
+    '''Header, filters and visuals, rerun on their own when filters are applied or a table is paged.'''
+    with fragment_run(), span_tags(page='leaderboard', dataset=l_file_path):
+        dataset = get_data(storage_account, container, l_file_path)
+        universal_layout('Player Leaderboard', dataset)
+        with span('widgets'):
+            l_get_filters(dataset, l_prefix)
+        with span('filter'):
+            selected_rows = query_data(dataset, l_categorical_filters, l_prefix)
+        l_build_graphs(dataset, selected_rows)
 
-    with tab1:
-        initialize_state(l_categorical_filters, l_prefix)
-        universal_layout('Player Leaderboard')
-        df = get_data(storage_account, container, l_file_path)
-        l_get_filters(df, l_prefix)
-        transformed_df = query_data(df, l_categorical_filters,l_prefix)
-        l_build_graphs(transformed_df)
 
-    with tab2:
-        initialize_state(cc_categorical_filters, cc_prefix)
-        universal_layout('Civ Counter-picker')
-        df = get_data(storage_account, container, cc_file_path)
-        cc_get_filters(df, cc_prefix)
-        transformed_df = query_data(df, cc_categorical_filters, cc_prefix)
-        cc_build_graphs(transformed_df)
+def civ_compare_page():
+    initialize_state(cc_categorical_filters, cc_prefix)
+    civ_compare_view()
 
-    with tab3:
-        initialize_state(cp_categorical_filters, cp_prefix)
-        universal_layout('Civ Performance')
-        df = get_data(storage_account, container, cp_file_path)
-        cp_get_filters(df, cp_prefix)
-        transformed_df = query_data(df, cp_categorical_filters, cp_prefix)
-        cp_build_graphs(transformed_df)
 
+@st.fragment
+def civ_compare_view():
+    '''Header, filters and visuals, rerun on their own when filters are applied or a table is paged.'''
+    with fragment_run(), span_tags(page='civ_compare', dataset=cc_file_path):
+        dataset = get_data(storage_account, container, cc_file_path)
+        universal_layout('Civ Counter-picker', dataset)
+        with span('widgets'):
+            cc_get_filters(dataset, cc_prefix)
+        # Filtering is a slice of the precomputed matchup cube, so no row selection is needed here
+        cc_build_graphs(dataset, get_selections(cc_categorical_filters, cc_prefix))
 
-print(f"The app has been run at {time.time()}")
-main()
+
+def civ_performance_page():
+    initialize_state(cp_categorical_filters, cp_prefix)
+    civ_performance_view()
+
+
+@st.fragment
+def civ_performance_view():
+    '''Header, filters and visuals, rerun on their own when a filter changes or a table is paged.'''
+    with fragment_run(), span_tags(page='civ_performance', dataset=cp_file_path):
+        dataset = get_data(storage_account, container, cp_file_path)
+        universal_layout('Civ Performance', dataset)
+        with span('widgets'):
+            cp_get_filters(dataset, cp_prefix)
+        # The selected series is looked up in a precomputed index, so no row selection is needed here
+        cp_build_graphs(dataset, get_selections(cp_categorical_filters, cp_prefix))
+
+
+def main():
+    '''Only the selected page is executed on a rerun, so a filter change on one page
+        never re-runs the pipelines of the other pages. Within a page, the filters and visuals are a fragment
+        (the `*_view` functions, header included so it always shows the dataset being displayed): applying filters
+        reruns just that block, not the navigation or prefetch.
+    '''
+    pages = [
+        st.Page(leaderboard_page, title="Player Leaderboard", url_path="leaderboard", default=True),
+        st.Page(civ_compare_page, title="Civ Counter-picker", url_path="civ-counter-picker"),
+        st.Page(civ_performance_page, title="Civ Performance", url_path="civ-performance"),
+    ]
+    page = st.navigation(pages, position="top")
+    prefetch_data(storage_account, container, registered_file_paths)
+    start_refresher()
+    page.run()
+
+
+begin_rerun()
+try:
+    with span('rerun'):
+        main()
+finally:
+    end_rerun()
 
 
 
@@ -90,9 +141,9 @@ main()
 # 1. Initialise state for all session state variable. This includes creating a 'reset filters' button.          --UNIVERSAL
 # 2. Get the data from adls2                                                                                    --UNIVERSAL in this project
 # 3. Establish filters on the page (the `get_filters` function), this is unique to each page.                   --BESPOKE
-# 4. The `query_data` ticks the rows to apply any filtering on the data dataframe (via a `selected` field)      --UNIVERSAL
+# 4. The `query_data` works out which rows match the filters and returns them (the shared df is never modified)  --UNIVERSAL
 #   NOTE: This is on the backend data of the df, not the one displayed just yet.
-# 5. In `build_graphs` we apply the filtering from the `selected` field, and any other transformations.         --BESPOKE
+# 5. In `build_graphs` we apply the filtering via `select_data`, and any other transformations.                  --BESPOKE
 #   It is also here we display the dataframe or visual required.
 #   NOTE: This will be the end visual dataframe's data.
-# 6. `updated_state` looks for any filters that have been applied, and reruns the script with the new filters.  --UNIVERSAL
\ No newline at end of file
+# 6. Filters are batched in a form, Apply reruns only the page's `*_view` fragment with the new filters.        --UNIVERSAL
\ No newline at end of file
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import streamlit as st
+from aoe_app_cache import CACHE_DIR, snapshot_key, write_atomic, remove_quietly
+from aoe_app_telemetry import span
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Optional query engine mode, turned on with AOE_QUERY_ENGINE=duckdb (and duckdb installed).
+# Pages declare their filters and aggregation as a spec instead of running eager pandas steps:
+#   filters:  columns filtered by the page's selections (an empty selection means all values)
+#   group_by: output columns, also the sort order
+#   measures: {output column: (source column, aggregate)}
+# An embedded duckdb instance runs the spec as one SQL query over a parquet copy of the loaded dataset version, so only
+# the referenced columns and matching row groups are read, and aggregation uses every core. The dataset is still held in
+# memory for the rest of the app, so the mode speeds up aggregation but does not reduce memory use.
+# The copies live in their own directory, outside the snapshot cache's eviction. Several workers can hold different
+# versions at once (until each one's refresher picks up the new one), so copies are only removed once none of them has
+# used one for AOE_QUERY_COPY_MAX_AGE seconds (see `cleanup_query_copies`).
+# Without the mode (the default) pages keep using their precomputed in-memory structures.
+QUERY_ENGINE = os.environ.get('AOE_QUERY_ENGINE', 'pandas').lower()
+DUCKDB_THREADS = int(os.environ.get('AOE_DUCKDB_THREADS', 0))
+DUCKDB_MEMORY_LIMIT = os.environ.get('AOE_DUCKDB_MEMORY_LIMIT')
+AGGREGATES = {'sum', 'count', 'min', 'max', 'avg'}
+QUERY_DIR = os.path.join(CACHE_DIR, 'query_engine')
+QUERY_COPY_MAX_AGE_SECONDS = float(os.environ.get('AOE_QUERY_COPY_MAX_AGE', 3600))
+
+logger = logging.getLogger('aoe_app.query')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def engine_enabled():
+    return QUERY_ENGINE == 'duckdb' and duckdb is not None
+
+
+@st.cache_resource(show_spinner=False)
+def get_connection():
+    '''One in-memory duckdb database per process, each query runs on its own cursor.'''
+    config = {}
+    if DUCKDB_THREADS > 0:
+        config['threads'] = DUCKDB_THREADS
+    if DUCKDB_MEMORY_LIMIT:
+        config['memory_limit'] = DUCKDB_MEMORY_LIMIT
+    return duckdb.connect(database=':memory:', config=config)
+
+
+def _parquet_path(dataset):
+    return os.path.join(QUERY_DIR, f"{snapshot_key('query_engine', '', dataset.name, dataset.version)}.parquet")
+
+
+def dataset_parquet(dataset):
+    '''Path of the engine's parquet copy of a dataset version, written the first time the engine needs it.
+        Each use bumps its mtime, so copies still in use by any worker are never old enough to be cleaned up.
+    '''
+    path = _parquet_path(dataset)
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(QUERY_DIR, exist_ok=True)
+    write_atomic(path, lambda tmp_path: dataset.df.to_parquet(tmp_path, index=False))
+    return path
+
+
+def cleanup_query_copies(max_age=QUERY_COPY_MAX_AGE_SECONDS):
+    '''Remove the engine's copies (and abandoned temp files) that no worker has used for `max_age` seconds.
+        Run by the background refresher, never on the request path.
+    '''
+    try:
+        names = os.listdir(QUERY_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(QUERY_DIR, name)
+        try:
+            if time.time() - os.stat(path).st_mtime > max_age:
+                remove_quietly(path)
+        except FileNotFoundError:
+            continue
+
+
+def _quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def build_sql(spec, selections):
+    '''SQL text and parameters for a page spec and its {column: values} selections.'''
+    where, params = [], []
+    for col in spec['filters']:
+        values = (selections or {}).get(col)
+        if values:
+            where.append(f"{_quote(col)} IN ({', '.join('?' * len(values))})")
+            params.extend(str(value) for value in values)
+
+    columns = [_quote(col) for col in spec['group_by']]
+    for name, (col, aggregate) in spec['measures'].items():
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Unsupported aggregate '{aggregate}', expected one of {sorted(AGGREGATES)}")
+        expression = f"{aggregate}({_quote(col)})"
+        # duckdb widens integer sums to HUGEINT, which pandas would turn into floats
+        if aggregate in ('sum', 'count'):
+            expression = f"CAST({expression} AS BIGINT)"
+        columns.append(f"{expression} AS {_quote(name)}")
+
+    group_by = ', '.join(_quote(col) for col in spec['group_by'])
+    sql = f"SELECT {', '.join(columns)} FROM read_parquet(?)"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if group_by:
+        sql += f" GROUP BY {group_by} ORDER BY {group_by}"
+    return sql, params
+
+
+def run_query(dataset, spec, selections):
+    '''Run a page spec against the dataset with duckdb. Returns None when the engine mode is off, unavailable or fails.'''
+    if not engine_enabled() or dataset.version is None:
+        return None
+
+    sql, params = build_sql(spec, selections)
+    with span('query_engine', engine='duckdb'):
+        try:
+            return get_connection().cursor().execute(sql, [dataset_parquet(dataset)] + params).df()
+        except Exception as e:
+            # e.g. the copy was cleaned up mid-query, the page falls back to its in-memory structures
+            logger.warning(f"Query engine failed for {dataset.name}, using the in-memory path: {e}")
+            return None
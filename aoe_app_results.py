@@ -0,0 +1,114 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Process-wide LRU cache of each page's final results (aggregated frames, chart data) for a filter selection.
+# Entries are keyed by (dataset name, dataset version, page, normalised selection) and shared by every session, so
+# switching back to a civ / map / elo combination anyone has viewed recently skips the aggregation entirely.
+#   - least recently used entries are evicted once the cached frames exceed AOE_RESULT_CACHE_MB
+#   - when a page sees a new dataset version, every entry for the old version is dropped straight away
+# Cached results are shared, callers must treat them as read-only.
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get('AOE_RESULT_CACHE_MB', 64)) * 1024 * 1024)
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def normalize_selections(selections):
+    '''Order-independent key for {column: values}, ignoring columns with nothing selected.'''
+    return tuple(sorted(
+        (col, tuple(sorted({str(value) for value in values})))
+        for col, values in (selections or {}).items() if values
+    ))
+
+
+def result_size(value):
+    '''Approximate bytes held by a cached result (frames and arrays inside dicts, lists and tuples).
+        Charts (e.g. Altair) count the frames they hold in `data`, plus those of any layers.
+    '''
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(result_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(result_size(item) for item in value)
+    data = getattr(value, 'data', None)
+    layers = getattr(value, 'layer', None)
+    if isinstance(data, pd.DataFrame) or isinstance(layers, list):
+        return result_size(data) + (result_size(layers) if isinstance(layers, list) else 0)
+    return 0
+
+
+class ResultCache:
+    '''Thread-safe LRU of page results under a memory budget, with hit / miss / eviction counters.'''
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_build(self, dataset, page, selections, build):
+        '''The cached result for this dataset version, page and selection, calling `build()` on a miss.'''
+        key = (dataset.name, dataset.version, page, normalize_selections(selections))
+        with self._lock:
+            self._invalidate(dataset.name, page, dataset.version)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        # Built outside the lock so one slow aggregation doesn't hold up every other session
+        value = build()
+        size = result_size(value)
+        with self._lock:
+            if size <= self.max_bytes and key not in self._entries and self._versions.get((key[0], page)) == key[1]:
+                self._entries[key] = (value, size)
+                self._bytes += size
+                self._evict()
+        return value
+
+    def _invalidate(self, name, page, version):
+        '''Drop the page's entries for any other version of the dataset.'''
+        if self._versions.get((name, page), version) != version:
+            for key in [key for key in self._entries if key[0] == name and key[2] == page and key[1] != version]:
+                self._bytes -= self._entries.pop(key)[1]
+        self._versions[(name, page)] = version
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._bytes = 0
+
+
+# Shared by every session in the process
+result_cache = ResultCache()
@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import pandas as pd
+import pyarrow as pa
+from aoe_app_cache import write_atomic, remove_quietly
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Host-wide shared copies of loaded datasets, as uncompressed Arrow IPC files in shared memory (/dev/shm when present).
+# The first worker process to load a dataset version publishes it here. Every other process on the host (and any later
+# restart) memory-maps the same file instead of downloading and parsing its own copy. The resulting DataFrame's numeric,
+# date and categorical code columns point straight into the mapped pages, so they are read-only and the operating
+# system holds one physical copy however many workers and sessions use it.
+#
+# Files are written with `aoe_app_cache.write_atomic`, like the snapshot cache. Publishing a new version unlinks the
+# older ones, processes still mapping them keep their pages until they let go.
+SHARED_MEMORY_ENABLED = os.environ.get('AOE_SHARED_MEMORY', 'True').lower() == 'true'
+SHARED_DIR = os.environ.get(
+    'AOE_SHARED_DIR',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'aoe_app_shared')
+)
+SHARED_SUFFIX = '.arrow'
+# Arrow schema metadata key holding the caller's extra state (e.g. loaded partitions)
+METADATA_KEY = b'aoe_app'
+
+logger = logging.getLogger('aoe_app.shared')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _hash(*parts):
+    return hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+def _shared_path(storage_account, container, file_path, version):
+    # Named <dataset>-<version>, so every version of a dataset shares a prefix and old ones can be found and removed
+    return os.path.join(
+        SHARED_DIR, f"{_hash(storage_account, container, file_path)}-{_hash(version)}{SHARED_SUFFIX}"
+    )
+
+
+def attach_shared(storage_account, container, file_path, version):
+    '''Map the published copy of a dataset version. Returns (df, metadata), or (None, None) when none is published.'''
+    if not SHARED_MEMORY_ENABLED or version is None:
+        return None, None
+
+    path = _shared_path(storage_account, container, file_path, version)
+    try:
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable shared dataset {path}: {e}")
+        return None, None
+
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b'{}'))
+    # split_blocks keeps one block per column, letting pandas wrap the mapped buffers rather than consolidating copies
+    return table.to_pandas(split_blocks=True), metadata
+
+
+def publish_shared(storage_account, container, file_path, version, df: pd.DataFrame, metadata=None):
+    '''Write `df` as the shared copy of a dataset version, then remove the dataset's older versions.
+        Failures (e.g. a full /dev/shm) only mean this process keeps its own private copy.
+    '''
+    if not SHARED_MEMORY_ENABLED or version is None:
+        return
+
+    path = _shared_path(storage_account, container, file_path, version)
+
+    def write(tmp_path):
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    try:
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            METADATA_KEY: json.dumps(metadata or {}).encode('utf-8'),
+        })
+        write_atomic(path, write)
+    except Exception as e:
+        logger.warning(f"Unable to publish shared dataset {path}: {e}")
+        return
+
+    prefix = os.path.basename(path).split('-')[0] + '-'
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith(prefix) and name.endswith(SHARED_SUFFIX) and name != os.path.basename(path):
+            remove_quietly(os.path.join(SHARED_DIR, name))
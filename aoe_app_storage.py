@@ -0,0 +1,323 @@
+import os
+import io
+import time
+import logging
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.identity import ClientSecretCredential
+from azure.storage.filedatalake import DataLakeServiceClient
+from aoe_app_telemetry import TimedCredential, span, record
+from aoe_app_datasets import parse_csv
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Process-wide adls2 client layer.
+# One credential and one pooled HTTP transport per storage account are shared by every session, dataset read,
+# metadata check and refresh, so each fetch reuses a cached AAD token and an already open HTTPS connection.
+# ClientSecretCredential keeps its access token in memory and fetches a new one shortly before it expires.
+ADLS_POOL_SIZE = int(os.environ.get('AOE_ADLS_POOL_SIZE', 10))
+# Files larger than this are fetched with parallel ranged requests instead of a single sequential stream
+PARALLEL_DOWNLOAD_MIN_BYTES = 32 * 1024 * 1024
+DOWNLOAD_MAX_CONCURRENCY = int(os.environ.get('AOE_DOWNLOAD_CONCURRENCY', 4))
+# Size of the first GET and of every later ranged GET of a download. The sdk fetches the first range in full before
+# `chunks()` yields anything (32MB by default), so small ranges are what let a streamed parse start on the first bytes.
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get('AOE_DOWNLOAD_CHUNK_MB', 4)) * 1024 * 1024
+
+logger = logging.getLogger('aoe_app.storage')
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@st.cache_resource(show_spinner=False)
+def get_credential():
+    '''Try to build the credential from .env variables, falling back to streamlit secrets.
+        Token acquisitions are timed as `credential` spans.
+    '''
+    try:
+        credential = ClientSecretCredential(
+            tenant_id=os.getenv("AZURE_TENANT_ID"),
+            client_id=os.getenv("AZURE_CLIENT_ID"),
+            client_secret=os.getenv("AZURE_CLIENT_SECRET")
+        )
+    except:
+        # Retrieve secrets from Streamlit's secrets.toml
+        credential = ClientSecretCredential(
+            tenant_id=st.secrets["azure_tenant_id"],
+            client_id=st.secrets["azure_client_id"],
+            client_secret=st.secrets["azure_client_secret"]
+        )
+    return TimedCredential(credential)
+
+
+@st.cache_resource(show_spinner=False)
+def get_service_client(storage_account, pool_size=ADLS_POOL_SIZE, chunk_bytes=DOWNLOAD_CHUNK_BYTES):
+    '''One DataLakeServiceClient per storage account, backed by a keep-alive connection pool of `pool_size`.
+        Downloads are fetched in ranges of `chunk_bytes` (see `download_file_from_adls2`).
+    '''
+    session = requests.Session()
+    # Retries are left to the azure pipeline, same as the sdk's own default adapter
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False)
+    )
+    session.mount('https://', adapter)
+
+    return DataLakeServiceClient(
+        account_url=f'https://{storage_account}.dfs.core.windows.net',
+        credential=get_credential(),
+        transport=RequestsTransport(session=session, session_owner=False),
+        max_single_get_size=chunk_bytes,
+        max_chunk_get_size=chunk_bytes,
+    )
+
+
+def get_file_client(storage_account, container, file_path):
+    '''Build the adls2 file client for a single path in a container, on top of the shared service client.'''
+    file_system_client = get_service_client(storage_account).get_file_system_client(file_system=container)
+    return file_system_client.get_file_client(file_path)
+
+
+class ChunkStream(io.RawIOBase):
+    '''Read-only file object over an iterator of byte chunks (e.g. `StorageStreamDownloader.chunks()`).
+        Lets gzip and the CSV parser pull data as it arrives, so only one chunk is held in memory at a time.
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+        # Time spent waiting on the next chunk, i.e. the network share of a streamed read
+        self.wait_seconds = 0.0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            start = time.perf_counter()
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            finally:
+                self.wait_seconds += time.perf_counter() - start
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def get_file_version(storage_account, container, file_path):
+    '''Cheap metadata call returning the remote version (etag + last modified) of a file, or None on failure.'''
+    try:
+        properties = get_file_client(storage_account, container, file_path).get_file_properties()
+        return f"{properties.etag}|{properties.last_modified.isoformat()}"
+    except Exception as e:
+        logger.error(f"Unable to read file properties for {file_path}: {e}")
+        return None
+
+
+def download_file_from_adls2(storage_account, container, file_path, stream=True, max_concurrency=1, schema=None):
+    '''Download a gzipped csv from adls2 and parse it into a DataFrame with the dataset's `schema` (see `parse_csv`).
+        With `stream=True` the download is read chunk by chunk and fed straight to the decompressor and csv parser,
+        so parsing overlaps the transfer and peak memory stays close to the frame size.
+        Files over `PARALLEL_DOWNLOAD_MIN_BYTES` are instead fetched with `max_concurrency` parallel ranged requests
+        into one compressed buffer, which is then parsed the same way.
+        `stream=False` buffers the whole file before parsing, and is also the fallback when a streamed parse fails.
+    '''
+    try:
+        file_client = get_file_client(storage_account, container, file_path)
+        
+        # Download the file content
+        start = time.perf_counter()
+        download = file_client.download_file(max_concurrency=max_concurrency)
+        request_seconds = time.perf_counter() - start
+
+        if stream and max_concurrency > 1 and download.size > PARALLEL_DOWNLOAD_MIN_BYTES:
+            # Large file, the sdk's chunked parallel download beats a single sequential stream
+            buffer = io.BytesIO()
+            with span('download', bytes=download.size, parallel=max_concurrency):
+                download.readinto(buffer)
+            with span('decompress_parse'):
+                df = parse_csv(buffer.getbuffer(), schema, compression='gzip')
+            return df
+
+        if stream:
+            # Chunks -> gzip -> csv parser, nothing is ever fully buffered
+            # The stages interleave, so the download share is the time spent waiting on chunks
+            chunks = ChunkStream(download.chunks())
+            start = time.perf_counter()
+            try:
+                df = parse_csv(io.BufferedReader(chunks), schema, compression='gzip')
+            except Exception as e:
+                # A stream can't be rewound for the pandas fallback, so fetch it again buffered
+                logger.warning(f"Streamed parse of {file_path} failed, retrying buffered: {e}")
+                return download_file_from_adls2(storage_account, container, file_path, stream=False, schema=schema)
+            record('download', request_seconds + chunks.wait_seconds, bytes=download.size, streamed=True)
+            record('decompress_parse', time.perf_counter() - start - chunks.wait_seconds, streamed=True)
+            return df
+
+        with span('download', bytes=download.size):
+            file_content = download.readall()
+        
+        # Decompress and parse the raw bytes in one multithreaded pass, no python str decode in between
+        with span('decompress_parse'):
+            df = parse_csv(file_content, schema, compression='gzip')
+        return df
+    except Exception as e:
+        st.error(f"Error downloading file: {e}")
+        return None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Storage backends: everything `get_data` needs from where the datasets live.
+# Chosen with AOE_STORAGE_BACKEND:
+#   adls  (default) the adls2 container, through the shared client above
+#   local a local directory (AOE_LOCAL_DATA_DIR/<container>/<file_path>), for development, tests and benchmarks
+#         without azure credentials. Columnar copies (.arrow / .feather / .parquet) or an uncompressed .csv next to the
+#         requested path are preferred and read through a memory map, so the file is never copied into a buffer first.
+LOCAL_ALTERNATE_SUFFIXES = ['.arrow', '.feather', '.parquet', '.csv']
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class StorageBackend:
+    '''Interface for a dataset location.'''
+    # Whether parsed copies should be kept in the local parquet snapshot cache (see `aoe_app_cache`)
+    use_snapshot_cache = True
+
+    def get_version(self, file_path):
+        '''Cheap identifier that changes whenever the file changes, or None when it can't be read.'''
+        raise NotImplementedError
+
+    def read_dataframe(self, file_path, schema=None):
+        '''Load the file as a DataFrame (csvs parsed with the dataset's `schema`), or None on failure.'''
+        raise NotImplementedError
+
+    def is_mapped(self, file_path):
+        '''Whether `read_dataframe` memory-maps the file, so every process on the host already shares its pages.'''
+        return False
+
+    def list_partitions(self, dir_path):
+        '''{partition: {file_path: version}} for a `column=value` partitioned directory (e.g. `game_date=2024-01-31/`).
+            Empty when the directory doesn't exist or holds no partitions, so callers fall back to the single file.
+            None when the listing failed, so callers can tell "not partitioned" from "unknown right now".
+        '''
+        return {}
+
+
+class AdlsBackend(StorageBackend):
+    '''Datasets stored as gzipped csvs in an adls2 container.'''
+    def __init__(self, storage_account, container):
+        self.storage_account = storage_account
+        self.container = container
+
+    def get_version(self, file_path):
+        return get_file_version(self.storage_account, self.container, file_path)
+
+    def read_dataframe(self, file_path, schema=None):
+        return download_file_from_adls2(
+            self.storage_account, self.container, file_path, max_concurrency=DOWNLOAD_MAX_CONCURRENCY, schema=schema
+        )
+
+    def list_partitions(self, dir_path):
+        # One recursive listing returns every partition file with its etag, no per-file metadata calls needed
+        file_system_client = get_service_client(self.storage_account).get_file_system_client(file_system=self.container)
+        partitions = {}
+        try:
+            for path in file_system_client.get_paths(path=dir_path, recursive=True):
+                if path.is_directory:
+                    continue
+                partition, _, name = path.name[len(dir_path):].strip('/').partition('/')
+                if name and '=' in partition:
+                    partitions.setdefault(partition, {})[path.name] = f"{path.etag}|{path.last_modified.isoformat()}"
+        except ResourceNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Unable to list partitions under {dir_path}: {e}")
+            return None
+        return partitions
+
+
+class LocalBackend(StorageBackend):
+    '''Datasets mirrored into a local directory, read through memory maps where the format allows it.'''
+    # Columnar files are already as fast to load as a snapshot would be
+    use_snapshot_cache = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def resolve(self, file_path):
+        '''The local file to read for `file_path`, preferring a columnar or uncompressed copy.'''
+        path = os.path.join(self.root, file_path)
+        stem = path[:-len('.csv.gz')] if path.endswith('.csv.gz') else os.path.splitext(path)[0]
+        for suffix in LOCAL_ALTERNATE_SUFFIXES:
+            if os.path.exists(stem + suffix):
+                return stem + suffix
+        return path
+
+    def is_mapped(self, file_path):
+        return self.resolve(file_path).endswith(('.arrow', '.feather'))
+
+    def get_version(self, file_path):
+        try:
+            path = self.resolve(file_path)
+            stat = os.stat(path)
+            return f"{os.path.basename(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        except OSError as e:
+            logger.error(f"Unable to read file properties for {file_path}: {e}")
+            return None
+
+    def list_partitions(self, dir_path):
+        root = os.path.join(self.root, dir_path)
+        partitions = {}
+        try:
+            names = sorted(os.listdir(root))
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            logger.error(f"Unable to list partitions under {dir_path}: {e}")
+            return None
+        for partition in names:
+            partition_dir = os.path.join(root, partition)
+            if '=' not in partition or not os.path.isdir(partition_dir):
+                continue
+            for name in sorted(os.listdir(partition_dir)):
+                path = os.path.join(partition_dir, name)
+                file_path = f"{dir_path}/{partition}/{name}"
+                # Skip hidden files, and files shadowed by a columnar copy next to them (that copy is listed instead)
+                if name.startswith('.') or not os.path.isfile(path) or self.resolve(file_path) != path:
+                    continue
+                stat = os.stat(path)
+                partitions.setdefault(partition, {})[file_path] = f"{stat.st_mtime_ns}|{stat.st_size}"
+        return partitions
+
+    def read_dataframe(self, file_path, schema=None):
+        path = self.resolve(file_path)
+        try:
+            with span('read_local', format=os.path.basename(path).split('.', 1)[-1]):
+                if path.endswith(('.arrow', '.feather')):
+                    # Arrow IPC over a memory map: the table's buffers point straight into the mapped file
+                    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+                    return table.to_pandas(split_blocks=True)
+                if path.endswith('.parquet'):
+                    return pd.read_parquet(path, memory_map=True)
+                # csvs are parsed straight from the mapped bytes
+                buffer = pa.memory_map(path, 'r').read_buffer()
+                return parse_csv(buffer, schema, compression=None if path.endswith('.csv') else 'gzip')
+        except Exception as e:
+            st.error(f"Error reading local file: {e}")
+            return None
+
+
+@st.cache_resource(show_spinner=False)
+def get_backend(storage_account, container) -> StorageBackend:
+    '''The configured storage backend for a container, shared by the whole process.'''
+    backend = os.environ.get('AOE_STORAGE_BACKEND', 'adls').lower()
+    if backend == 'local':
+        return LocalBackend(os.path.join(os.environ.get('AOE_LOCAL_DATA_DIR', 'data'), container))
+    if backend == 'adls':
+        return AdlsBackend(storage_account, container)
+    raise ValueError(f"Unknown AOE_STORAGE_BACKEND '{backend}', expected 'adls' or 'local'")
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict, deque
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from aoe_app_results import result_cache
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Timing spans around each pipeline stage (credential, download, decompress, parse, filter, aggregate, chart, render).
+# Every span is tagged with the dataset and page it ran for and goes to three places:
+#   - the `aoe_app.perf` logger, one json line per span
+#   - a process-wide rolling window per stage, for percentiles across all sessions
+#   - the current session's list for this rerun, shown by the hidden diagnostics panel
+# The panel is shown with `?diagnostics=1` in the url or AOE_DIAGNOSTICS=true.
+ROLLING_WINDOW = 500
+DIAGNOSTICS_ENABLED = os.environ.get('AOE_DIAGNOSTICS', 'False').lower() == 'true'
+
+logger = logging.getLogger('aoe_app.perf')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get('AOE_PERF_LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+
+# Failures and fallbacks elsewhere in the app go to child loggers of `aoe_app` (e.g. `aoe_app.storage`), with levels
+app_logger = logging.getLogger('aoe_app')
+if not app_logger.handlers:
+    _app_handler = logging.StreamHandler()
+    _app_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    app_logger.addHandler(_app_handler)
+    app_logger.setLevel(os.environ.get('AOE_LOG_LEVEL', 'INFO'))
+    app_logger.propagate = False
+
+_rolling = defaultdict(lambda: deque(maxlen=ROLLING_WINDOW))
+_rolling_lock = threading.Lock()
+_context_tags = contextvars.ContextVar('aoe_perf_tags', default={})
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+@contextmanager
+def span_tags(**tags):
+    '''Tags (e.g. page, dataset) added to every span recorded inside this block.'''
+    token = _context_tags.set({**_context_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _context_tags.reset(token)
+
+
+def record(stage, seconds, **tags):
+    '''Record one finished span.'''
+    entry = {'stage': stage, 'ms': round(seconds * 1000, 3), **_context_tags.get(), **tags, 'at': time.time()}
+    logger.info(json.dumps(entry, default=str))
+
+    with _rolling_lock:
+        _rolling[stage].append(entry['ms'])
+
+    # Only script threads (and threads given their context) have a session to report to
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.session_state.setdefault('perf_spans', []).append(entry)
+
+
+@contextmanager
+def span(stage, **tags):
+    '''Time the enclosed block as `stage`.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **tags)
+
+
+def begin_rerun():
+    '''Start a fresh per-rerun breakdown for this session.'''
+    st.session_state['perf_spans'] = []
+    st.session_state['perf_full_rerun'] = True
+
+
+def end_rerun():
+    '''Mark the end of a full rerun, later fragment reruns start their own breakdown (see `fragment_run`).'''
+    st.session_state['perf_full_rerun'] = False
+
+
+@contextmanager
+def fragment_run():
+    '''Wrap the body of an `st.fragment`. A fragment rerun skips the top of the script, so it resets the breakdown
+        itself, and the diagnostics panel is drawn inside the fragment so it is redrawn with the fragment's spans.
+    '''
+    if not st.session_state.get('perf_full_rerun'):
+        st.session_state['perf_spans'] = []
+    yield
+    render_diagnostics()
+
+
+class TimedCredential:
+    '''Wraps an azure credential so each token acquisition is recorded as a `credential` span.
+        The sdk only asks for a token when its cached one is missing or about to expire.
+    '''
+    def __init__(self, credential):
+        self._credential = credential
+
+    def get_token(self, *scopes, **kwargs):
+        with span('credential'):
+            return self._credential.get_token(*scopes, **kwargs)
+
+    def close(self):
+        self._credential.close()
+
+
+def rolling_percentiles() -> pd.DataFrame:
+    '''p50 / p95 / p99 per stage over the last `ROLLING_WINDOW` spans of every session in this process.'''
+    with _rolling_lock:
+        samples = {stage: list(values) for stage, values in _rolling.items()}
+    rows = [
+        {
+            'stage': stage,
+            'count': len(values),
+            'p50_ms': np.percentile(values, 50),
+            'p95_ms': np.percentile(values, 95),
+            'p99_ms': np.percentile(values, 99),
+        }
+        for stage, values in sorted(samples.items()) if values
+    ]
+    return pd.DataFrame(rows)
+
+
+def diagnostics_enabled():
+    return DIAGNOSTICS_ENABLED or st.query_params.get('diagnostics') == '1'
+
+
+def render_diagnostics():
+    '''Hidden performance panel: this rerun's spans, the process-wide rolling percentiles and result cache counters.
+        Drawn from each page's fragment (see `fragment_run`).
+    '''
+    if not diagnostics_enabled():
+        return
+    with st.expander("Diagnostics - performance"):
+        left, right = st.columns(2)
+        with left:
+            st.markdown("**This rerun**")
+            st.dataframe(pd.DataFrame(st.session_state.get('perf_spans', [])))
+        with right:
+            st.markdown(f"**Rolling percentiles (last {ROLLING_WINDOW} per stage)**")
+            st.dataframe(rolling_percentiles())
+            st.markdown("**Result cache**")
+            st.dataframe(pd.DataFrame([result_cache.stats()]))
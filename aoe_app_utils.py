@@ -1,87 +1,362 @@
 import streamlit as st
 import pandas as pd
-from azure.identity import ClientSecretCredential
-from azure.storage.filedatalake import DataLakeServiceClient
-import io
-import gzip
+import numpy as np
+import threading
+import time
+import hashlib
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pandas.api.types import union_categoricals
 from streamlit import session_state as ss
 import os
 from dotenv import load_dotenv
+from aoe_app_cache import snapshot_key, load_snapshot, save_snapshot
+from aoe_app_shared import attach_shared, publish_shared
+from aoe_app_storage import get_backend
+from aoe_app_datasets import SCHEMAS, Dataset, apply_schema
+from aoe_app_index import build_filter_index, select_rows
+from aoe_app_query import cleanup_query_copies
+from aoe_app_telemetry import span, span_tags
 
 # Load .env only if not on Cloud
 if not os.environ.get('STREAMLIT_CLOUD_RUN', 'False').lower() == 'true':
     load_dotenv() 
 
+# Rows sent to the browser per table page
+TABLE_PAGE_SIZE = 100
+
+# Partitions behind each partitioned dataset currently loaded in this process, so a reload only fetches the delta:
+# {(storage_account, container, file_path): {'df': frame, 'partitions': {partition: (version, start_row, stop_row)}}}
+_loaded_partitions = {}
+_loaded_partitions_lock = threading.Lock()
+
+logger = logging.getLogger('aoe_app.data')
 
 # ----------------------------------------------------------------------------------------------------------------------
-def download_file_from_adls2(adls2_credential, storage_account, container, file_path):
-    try:
-        # Create a DataLakeServiceClient
-        adls2_client = DataLakeServiceClient(
-            account_url=f'https://{storage_account}.dfs.core.windows.net',
-            credential=adls2_credential
-        )
-        
-        # Get the file system client (container)
-        file_system_client = adls2_client.get_file_system_client(file_system=container)
-        
-        # Get the file client (FIX: use get_file_client() instead of get_path_client())
-        file_client = file_system_client.get_file_client(file_path)
-        
-        # Download the file content
-        download = file_client.download_file()
-        file_content = download.readall()
-        
-        # Decompress the file content
-        with gzip.GzipFile(fileobj=io.BytesIO(file_content)) as f:
-            decompressed_content = f.read()
-        
-        # Load the decompressed file content into a pandas DataFrame
-        df = pd.read_csv(io.StringIO(decompressed_content.decode('utf-8')))
-        return df
-    except Exception as e:
-        st.error(f"Error downloading file: {e}")
-        return None
+# Process-wide registry of the current copy of every dataset, {(storage_account, container, file_path): Dataset}.
+# Sessions always read whatever copy is registered, so they never wait on a reload. The background refresher
+# (`start_refresher`) checks each dataset's remote version every AOE_REFRESH_INTERVAL seconds (0 disables it), loads
+# new versions off the request path and swaps them in with a single assignment. A rerun already holding the old copy
+# keeps using it until it finishes, so no session ever sees a half updated dataset.
+REFRESH_INTERVAL_SECONDS = float(os.environ.get('AOE_REFRESH_INTERVAL', 300))
 
+_datasets = {}
+_datasets_lock = threading.Lock()
+_load_locks = defaultdict(threading.Lock)
+# ----------------------------------------------------------------------------------------------------------------------
 
 
-@st.cache_data
-def get_data(storage_account, container, file_path):
+def get_data(storage_account, container, file_path) -> Dataset:
     """
-    Try to connect to adls2 using either .env variables or streamlit secrets
-    If successful, call the download function to read it as a dataframe
-    """    
-
-    try:
-        adls2_credential = ClientSecretCredential(
-            tenant_id=os.getenv("AZURE_TENANT_ID"),
-            client_id=os.getenv("AZURE_CLIENT_ID"),
-            client_secret=os.getenv("AZURE_CLIENT_SECRET")
-        )
-    except:
-        # Retrieve secrets from Streamlit's secrets.toml
-        client_id = st.secrets["azure_client_id"]
-        tenant_id = st.secrets["azure_tenant_id"]
-        client_secret = st.secrets["azure_client_secret"]
-
-        # Create a credential object for Azure authentication
-        adls2_credential = ClientSecretCredential(
-            tenant_id=tenant_id,
-            client_id=client_id,
-            client_secret=client_secret
-        )
+    The current copy of a dataset, shared by every session, so it must never be modified in place
+    Loaded on first use (concurrent sessions wait on the same load), then kept up to date by the background refresher
+    """
+    dataset = load_registered(storage_account, container, file_path)
+    if dataset is None:
+        # Nothing is registered on a failure, so the next run retries
+        st.error("Unable to read data.")
+        st.stop()
+    return dataset
+
+
+def load_registered(storage_account, container, file_path):
+    '''The registered copy of a dataset, loading and registering it first if needed. None when the load fails.'''
+    key = (storage_account, container, file_path)
+    dataset = _datasets.get(key)
+    if dataset is None:
+        with _datasets_lock:
+            load_lock = _load_locks[key]
+        with load_lock:
+            dataset = _datasets.get(key)
+            if dataset is None:
+                dataset = load_dataset(storage_account, container, file_path)
+                if dataset is not None:
+                    with _datasets_lock:
+                        _datasets[key] = dataset
+    return dataset
+
+
+def load_dataset(storage_account, container, file_path, version=None):
+    """
+    Read a dataset through the configured storage backend (see `aoe_app_storage.get_backend`), or None on failure
+    `version` is the remote version when the caller has just checked it (e.g. the refresher), saving a metadata call
+    A copy of the same version already published on this host by another worker is mapped instead (see `aoe_app_shared`)
+    Datasets with a partitioned layout declared in their schema are read partition by partition (see `load_partitions`)
+    Otherwise the local snapshot is used when the remote version is unchanged, or the single file is downloaded
+    """
+    backend = get_backend(storage_account, container)
+    schema = SCHEMAS.get(file_path) or {}
+    partitioned = bool(schema.get('partitions'))
+    with span_tags(dataset=file_path):
+        if version is None:
+            with span('metadata'):
+                version = get_remote_version(backend, file_path, schema)
+        with span('shared_attach'):
+            df, metadata = attach_shared(storage_account, container, file_path, version)
+
+        if df is not None:
+            # When the publishing worker loaded it, not when we mapped it
+            loaded_at = metadata.get('loaded_at', time.time())
+            if metadata.get('partitions'):
+                # Later reloads in this process can still fetch just the changed partitions
+                with _loaded_partitions_lock:
+                    _loaded_partitions[(storage_account, container, file_path)] = {
+                        'df': df,
+                        'partitions': {partition: tuple(loaded) for partition, loaded in metadata['partitions'].items()},
+                    }
+        else:
+            if partitioned:
+                loaded = load_partitions(backend, storage_account, container, file_path, schema)
+                if loaded is None:
+                    # The listing failed, the single file may be a stale copy of the partitioned layout
+                    return None
+                df, version = loaded
+            from_partitions = df is not None
+            if df is None:
+                df, version = load_file(
+                    backend, storage_account, container, file_path, schema, None if partitioned else version
+                )
+            if df is None:
+                return None
+            loaded_at = time.time()
+            # A frame the backend mapped straight from a columnar file is already shared, publishing would copy it
+            if from_partitions or not backend.is_mapped(file_path):
+                with span('shared_publish'):
+                    df = share_dataset(storage_account, container, file_path, version, df, loaded_at)
 
-    
-    # Download the file and load it into a DataFrame
-    df = download_file_from_adls2(adls2_credential, storage_account, container, file_path)
-    print("file downloaded")
-    df['selected'] = True
-    if df is not None:
-        pass
         # st.toast("Successfuly read data!")
+        with span('index'):
+            filter_index = build_filter_index(df)
+        return Dataset(
+            name=file_path,
+            df=df,
+            version=version,
+            loaded_at=loaded_at,
+            filter_index=filter_index,
+        )
+
+
+def share_dataset(storage_account, container, file_path, version, df, loaded_at):
+    '''Publish a freshly loaded frame for the other workers on this host and switch to the mapped copy ourselves,
+        so the private copy can be freed. Returns `df` unchanged when sharing is disabled or fails.
+    '''
+    state_key = (storage_account, container, file_path)
+    with _loaded_partitions_lock:
+        loaded = _loaded_partitions.get(state_key)
+    partitioned = loaded is not None and loaded['df'] is df
+    metadata = {'loaded_at': loaded_at}
+    if partitioned:
+        metadata['partitions'] = loaded['partitions']
+
+    publish_shared(storage_account, container, file_path, version, df, metadata)
+    shared_df, _ = attach_shared(storage_account, container, file_path, version)
+    if shared_df is None:
+        return df
+
+    if partitioned:
+        with _loaded_partitions_lock:
+            _loaded_partitions[state_key] = {'df': shared_df, 'partitions': loaded['partitions']}
+    return shared_df
+
+
+def get_remote_version(backend, file_path, schema):
+    '''The version `load_dataset` would give the dataset right now, from metadata calls only. None when unknown.'''
+    if schema.get('partitions'):
+        listing = backend.list_partitions(schema['partitions']['path'])
+        if listing is None:
+            # Unknown layout, falling back to the single file's version would swap copies back and forth
+            return None
+        if listing:
+            return partitions_version({partition: partition_version(files) for partition, files in listing.items()})
+    return backend.get_version(file_path)
+
+
+def refresh_datasets():
+    '''Reload every registered dataset whose remote version has changed, swapping in each new copy once it is ready.'''
+    with _datasets_lock:
+        current = dict(_datasets)
+
+    for key, dataset in current.items():
+        storage_account, container, file_path = key
+        with span_tags(dataset=file_path, page='refresher'):
+            backend = get_backend(storage_account, container)
+            with span('refresh_check'):
+                version = get_remote_version(backend, file_path, SCHEMAS.get(file_path) or {})
+            if version is None or version == dataset.version:
+                continue
+
+            with span('refresh'):
+                refreshed = load_dataset(storage_account, container, file_path, version)
+            if refreshed is not None:
+                with _datasets_lock:
+                    _datasets[key] = refreshed
+
+
+def _refresh_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh_datasets()
+            cleanup_query_copies()
+        except Exception as e:
+            # Keep serving the current copies and try again on the next tick
+            logger.exception(f"Background dataset refresh failed: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def start_refresher(interval=REFRESH_INTERVAL_SECONDS):
+    '''Start the background refresher thread, once per process. Returns None when refreshing is disabled.'''
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=_refresh_loop, args=(interval,), name='aoe-dataset-refresher', daemon=True)
+    thread.start()
+    return thread
+
+
+def load_file(backend, storage_account, container, file_path, schema, version=None):
+    '''Load a single file dataset, from the local snapshot when its version is unchanged. Returns (df, version).
+        `version` is looked up when the caller doesn't already know it.
+    '''
+    # Check the local parquet snapshot first, keyed on the remote version so a changed file is always re-downloaded
+    if version is None:
+        with span('metadata'):
+            version = backend.get_version(file_path)
+    key = None
+    if version and backend.use_snapshot_cache:
+        key = snapshot_key(storage_account, container, file_path, version)
+    with span('snapshot_load'):
+        df = load_snapshot(key) if key else None
+
+    if df is None:
+        # Download the file and load it into a DataFrame
+        df = backend.read_dataframe(file_path, schema)
+        if df is not None:
+            with span('schema'):
+                df = apply_schema(df, schema)
+        if df is not None and key:
+            with span('snapshot_save'):
+                save_snapshot(key, df)
     else:
-        st.error("Unable to read data.")
+        with span('schema'):
+            df = apply_schema(df, schema)
+    return df, version
+
+
+def load_partitions(backend, storage_account, container, file_path, schema):
+    '''Load a `column=value` partitioned dataset, fetching only partitions that are new or changed since the last load.
+        Unchanged partitions are sliced out of the previously loaded frame, so a daily refresh downloads one day of data
+        rather than the full history. Returns (df, version), (None, None) when there are no partitions to read,
+        or None when the listing failed.
+    '''
+    partitioning = schema['partitions']
+    with span('metadata', partitioned=True):
+        listing = backend.list_partitions(partitioning['path'])
+    if listing is None:
+        return None
+    if not listing:
+        return None, None
+
+    state_key = (storage_account, container, file_path)
+    with _loaded_partitions_lock:
+        previous = _loaded_partitions.get(state_key, {'df': None, 'partitions': {}})
+
+    frames, partitions, fetched = [], {}, 0
+    row = 0
+    for partition in sorted(listing):
+        files = listing[partition]
+        version = partition_version(files)
+        loaded = previous['partitions'].get(partition)
+        if loaded is not None and loaded[0] == version:
+            frame = previous['df'].iloc[loaded[1]:loaded[2]]
+        else:
+            with span('partition_load', partition=partition):
+                frame = load_partition(backend, storage_account, container, partition, files, version, schema)
+            if frame is None:
+                return None, None
+            fetched += 1
+        frames.append(frame)
+        partitions[partition] = (version, row, row + len(frame))
+        row += len(frame)
+
+    with span('partition_concat', partitions=len(frames), fetched=fetched):
+        df = concat_partitions(frames, schema.get('categories', []))
+
+    with _loaded_partitions_lock:
+        _loaded_partitions[state_key] = {'df': df, 'partitions': partitions}
+
+    return df, partitions_version({partition: loaded[0] for partition, loaded in partitions.items()})
+
+
+def partition_version(files):
+    '''Version of one partition, from the {file_path: version} of its files.'''
+    return '|'.join(f"{path}={version}" for path, version in sorted(files.items()))
+
+
+def partitions_version(versions):
+    '''Version of a partitioned dataset, from the {partition: version} of its partitions.'''
+    raw = '\n'.join(f"{partition}:{version}" for partition, version in sorted(versions.items()))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def load_partition(backend, storage_account, container, partition, files, partition_version, schema):
+    '''Read every file of one partition into a single frame with the schema applied, via the snapshot cache.'''
+    key = None
+    if backend.use_snapshot_cache:
+        key = snapshot_key(storage_account, container, partition, partition_version)
+        df = load_snapshot(key)
+        if df is not None:
+            return apply_schema(df, schema)
+
+    parts = [backend.read_dataframe(path, schema) for path in sorted(files)]
+    if any(part is None for part in parts):
+        return None
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+
+    # Hive style layouts leave the partition column out of the files themselves (parsed as all missing)
+    column, _, value = partition.partition('=')
+    if column not in df.columns or df[column].isna().all():
+        df[column] = value
+    df = apply_schema(df, schema)
+    if key:
+        save_snapshot(key, df)
     return df
+
+
+def concat_partitions(frames, categories) -> pd.DataFrame:
+    '''Stack partition frames in order. Categorical columns are merged with `union_categoricals` (sorted, like
+        `apply_schema` leaves them) instead of letting `concat` fall back to slow object columns.
+    '''
+    columns = frames[0].columns
+    merged = {
+        col: union_categoricals([frame[col] for frame in frames], sort_categories=True)
+        for col in categories
+        if col in columns and all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames)
+    }
+    df = pd.concat([frame.drop(columns=list(merged)) for frame in frames], ignore_index=True)
+    for col, values in merged.items():
+        df[col] = values
+    return df[list(columns)]
+
+
+@st.cache_resource(show_spinner="Loading datasets...")
+def prefetch_data(storage_account, container, file_paths):
+    '''Fetch and parse every dataset in parallel on a cold start, once per process.
+        Each worker calls `load_registered`, so the results land in the same registry the pages read from and
+        cold start costs roughly the slowest single file rather than the sum of all of them.
+        A dataset that fails is only logged here, leaving the error to the page that needs it (see `get_data`).
+        Workers run without the session's script context, like the refresher, so nothing they show lands on
+        whichever page happens to be open.
+    '''
+    def prefetch(file_path):
+        try:
+            if load_registered(storage_account, container, file_path) is None:
+                logger.error(f"Prefetch failed to load {file_path}")
+        except Exception as e:
+            logger.exception(f"Prefetch failed to load {file_path}: {e}")
+
+    with ThreadPoolExecutor(max_workers=len(file_paths)) as executor:
+        list(executor.map(prefetch, file_paths))
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -102,12 +377,111 @@ def reset_state_callback():
         # if key.endswith("_query"):
         st.session_state[key] = []
 
-def query_data(df: pd.DataFrame, categorical_filters, prefix) -> pd.DataFrame:
-    '''Filter the DataFrame based on session state selections.'''
+def get_selections(categorical_filters, prefix):
+    '''The current {column: selected values} for a page, read from session state.'''
+    return {col: st.session_state[f"{prefix}_{col}_query"] for col in categorical_filters}
+
+
+def query_data(dataset: Dataset, categorical_filters, prefix):
+    '''Work out which rows match the session state selections, without touching the shared data.
+        Returns the sorted row numbers to keep, or None when no filter is applied (all rows).
+        The matching rows come from the dataset's posting-list index, falling back to an `isin` scan
+        for columns that are not indexed.
+    '''
+    selections = get_selections(categorical_filters, prefix)
+
+    if all(col in dataset.filter_index for col in categorical_filters):
+        return select_rows(dataset.filter_index, selections)
+
+    mask = None
     for col in categorical_filters:
-        if st.session_state[f"{prefix}_{col}_query"]:
-            df["selected"] &= df[col].isin(st.session_state[f"{prefix}_{col}_query"])
-    return df
+        if selections[col]:
+            col_mask = dataset.df[col].isin(selections[col]).to_numpy()
+            mask = col_mask if mask is None else mask & col_mask
+    return None if mask is None else np.flatnonzero(mask)
+
+
+def get_options(dataset: Dataset, col, selections=None):
+    '''Sorted widget options for `col`, computed once per dataset version straight from the categories.
+        Given {column: values} `selections` on other columns, only values that still have matching rows are
+        offered (cascading filters), worked out from the posting-list index rather than a rescan.
+        Values already selected in `col` are always kept so the widget never drops them.
+    '''
+    options = dataset.artifact(f'options_{col}', lambda df: df[col].cat.categories.tolist())
+    others = {other: values for other, values in (selections or {}).items() if other != col and values}
+    if not others:
+        return options
+
+    rows = select_rows(dataset.filter_index, others)
+    codes = np.unique(dataset.df[col].cat.codes.to_numpy()[rows])
+    # Missing values (code -1) are not an option
+    codes = set(codes[codes >= 0].tolist())
+    selected = (selections or {}).get(col) or []
+    codes.update(code for code in dataset.filter_index[col]['categories'].get_indexer(selected) if code != -1)
+    return [options[code] for code in sorted(codes)]
+
+
+def select_data(df: pd.DataFrame, selected_rows) -> pd.DataFrame:
+    '''The rows picked by `query_data`, or the whole frame when nothing is filtered.'''
+    if selected_rows is None:
+        return df
+    return df.iloc[selected_rows]
+
+
+def sort_order(values, descending=False) -> np.ndarray:
+    '''Stable row order for a column (categoricals sort by their already sorted categories).
+        Ties keep their original order and missing values come last in either direction.
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+    else:
+        codes, _ = pd.factorize(values, sort=True)
+    # Missing values have code -1, the last key is the primary one
+    order = np.lexsort((-codes if descending else codes, codes == -1))
+    # Cached per column and direction for the life of the dataset, so kept as compact as the filter index
+    return order.astype(np.int32) if len(order) < 2 ** 31 else order
+
+
+def paged_table(df: pd.DataFrame, key, page_size=TABLE_PAGE_SIZE, dataset: Dataset = None, rows=None):
+    '''Show `df` one page at a time, so only `page_size` rows are serialised and sent per rerun.
+        Sorting and paging happen here on the server. Pass `dataset` when `df` holds the dataset's own columns (renamed
+        or not, in the same order) for its `rows` (sorted row numbers from `query_data`, None for every row). The sort
+        order of each column is then worked out once per dataset version and narrowed to `rows`, not re-sorted.
+    '''
+    sort_col, direction_col, page_col = st.columns([3, 2, 2])
+    with sort_col:
+        sort_by = st.selectbox("Sort by", ["(none)"] + list(df.columns), key=f"{key}_sort_by")
+    with direction_col:
+        descending = st.toggle("Descending", key=f"{key}_descending")
+
+    n_pages = max(1, -(-len(df) // page_size))
+    with page_col:
+        page = st.number_input("Page", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+    page = min(int(page), n_pages)
+    start, stop = (page - 1) * page_size, min(page * page_size, len(df))
+
+    if sort_by == "(none)":
+        page_df = df.iloc[start:stop]
+    else:
+        with span('sort', table=key):
+            if dataset is not None:
+                column = dataset.df.columns[df.columns.get_loc(sort_by)]
+                order = dataset.artifact(
+                    f'sort_order_{column}_{descending}', lambda frame: sort_order(frame[column], descending)
+                )
+                if rows is not None:
+                    # The selected rows in sorted order, then their positions in `df`
+                    selected = np.zeros(len(dataset.df), dtype=bool)
+                    selected[rows] = True
+                    order = np.searchsorted(rows, order[selected[order]])
+            else:
+                order = sort_order(df[sort_by], descending)
+        page_df = df.iloc[order[start:stop]]
+
+    with span('render', table=key):
+        st.dataframe(page_df)
+
+    st.caption(f"Rows {start + 1 if stop else 0:,}-{stop:,} of {len(df):,}")
 
 
 # General flow:
@@ -115,9 +489,9 @@ def query_data(df: pd.DataFrame, categorical_filters, prefix) -> pd.DataFrame:
 # 1. Initialise state for all session state variable. This includes creating a 'reset filters' button.          --UNIVERSAL
 # 2. Get the data from adls2                                                                                    --UNIVERSAL in this project
 # 3. Establish filters on the page (the `get_filters` function), this is unique to each page.                   --BESPOKE
-# 4. The `query_data` ticks the rows to apply any filtering on the data dataframe (via a `selected` field)      --UNIVERSAL
+# 4. The `query_data` works out which rows match the filters and returns them (the shared df is never modified)  --UNIVERSAL
 #   NOTE: This is on the backend data of the df, not the one displayed just yet.
-# 5. In `build_graphs` we apply the filtering from the `selected` field, and any other transformations.         --BESPOKE
+# 5. In `build_graphs` we apply the filtering via `select_data`, and any other transformations.                  --BESPOKE
 #   It is also here we display the dataframe or visual required.
 #   NOTE: This will be the end visual dataframe's data.
 # 6. `updated_state` looks for any filters that have been applied, and reruns the script with the new filters.  --UNIVERSAL